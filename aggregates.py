@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+'''
+	Running aggregates over an entity's sibling ratings
+
+	The count, sum, sum of squares, minimum and maximum of the choices are
+	stored alongside the sibling set and adjusted by delta as siblings are
+	added or dominated, so the mean and variance never need a pass over all
+	the choices. Only dominating away the current minimum or maximum needs
+	the surviving choices to find the new one.
+
+	merge.lua keeps the same fields in the record; keep the two in step.
+'''
+
+# Hash fields the aggregates are stored under, in this order
+FIELDS = ('count', 'sum', 'sumsq', 'min', 'max')
+
+class Aggregates(object):
+	def __init__(self, count=0, sum=0.0, sumsq=0.0, min=None, max=None):
+		self.count = count
+		self.sum = sum
+		self.sumsq = sumsq
+		self.min = min
+		self.max = max
+
+	@classmethod
+	def fromChoices(cls, choices):
+		"""Compute the aggregates of a list of ratings from scratch."""
+		self = cls()
+		for rating in choices:
+			self.add(rating)
+		return self
+
+	@classmethod
+	def fromFields(cls, values):
+		"""Aggregates from the stored FIELDS, as returned by HMGET, or None if
+		the record has none yet."""
+		if values[0] is None:
+			return None
+		count, sum, sumsq, min, max = values
+		return cls(int(count), float(sum), float(sumsq), float(min), float(max))
+
+	def copy(self):
+		return Aggregates(self.count, self.sum, self.sumsq, self.min, self.max)
+
+	def add(self, rating):
+		"""A sibling with this rating was added."""
+		self.count += 1
+		self.sum += rating
+		self.sumsq += rating*rating
+		if self.min is None or rating < self.min: self.min = rating
+		if self.max is None or rating > self.max: self.max = rating
+
+	def remove(self, rating, choices):
+		"""A sibling with this rating was dominated; choices are the ratings
+		that survive, only looked at if rating was the minimum or maximum."""
+		self.count -= 1
+		self.sum -= rating
+		self.sumsq -= rating*rating
+		if not choices:
+			self.sum = self.sumsq = 0.0
+			self.min = self.max = None
+		elif rating <= self.min or rating >= self.max:
+			self.min, self.max = min(choices), max(choices)
+
+	@property
+	def mean(self):
+		return self.sum/self.count if self.count else None
+
+	@property
+	def variance(self):
+		"""Population variance of the choices."""
+		if not self.count:
+			return None
+		return max(self.sumsq/self.count - self.mean*self.mean, 0.0)
+
+	def fields(self):
+		"""The aggregates as a dictionary of FIELDS, for HMSET."""
+		return dict(zip(FIELDS, (self.count, repr(self.sum), repr(self.sumsq), repr(self.min), repr(self.max))))
+
+	def asDict(self):
+		"""Summary of the choices for responses."""
+		return { 'count': self.count, 'min': self.min, 'max': self.max, 'variance': self.variance }
+
+	def __eq__(self, other):
+		return (self.count, self.sum, self.sumsq, self.min, self.max) == \
+			(other.count, other.sum, other.sumsq, other.min, other.max)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return 'Aggregates(%r, %r, %r, %r, %r)' % (self.count, self.sum, self.sumsq, self.min, self.max)
+
+# -----------IGNOREBEYOND: test code ---------------
+import unittest
+
+
+class AggregatesTestCase(unittest.TestCase):
+	"""Test running aggregates"""
+
+	def testFromChoices(self):
+		aggregates = Aggregates.fromChoices([5.0, 2.0, 2.0])
+		self.assertEquals(aggregates, Aggregates(3, 9.0, 33.0, 2.0, 5.0))
+		self.assertEquals(aggregates.mean, 3.0)
+		self.assertEquals(aggregates.variance, 2.0)
+		self.assertEquals(Aggregates().mean, None)
+
+	def testDelta(self):
+		aggregates = Aggregates.fromChoices([5.0, 2.0, 4.0])
+		aggregates.remove(4.0, [5.0, 2.0])
+		self.assertEquals(aggregates, Aggregates.fromChoices([5.0, 2.0]))
+		aggregates.remove(5.0, [2.0])
+		aggregates.add(3.0)
+		self.assertEquals(aggregates, Aggregates.fromChoices([2.0, 3.0]))
+		aggregates.remove(2.0, [3.0])
+		aggregates.remove(3.0, [])
+		self.assertEquals(aggregates, Aggregates())
+
+	def testFields(self):
+		aggregates = Aggregates.fromChoices([0.1, 3.0])
+		fields = aggregates.fields()
+		self.assertEquals(Aggregates.fromFields([fields[field] for field in FIELDS]), aggregates)
+		self.assertEquals(Aggregates.fromFields([None]*len(FIELDS)), None)
+
+
+if __name__ == "__main__":
+	unittest.main()
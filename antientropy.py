@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+'''
+	Anti-entropy between regions that each accept writes
+
+	Every key falls in one of 16**DEPTH buckets by the SHA-1 of its name. A
+	bucket's digest is the sum of a number drawn from the SHA-1 of each of
+	its keys with the key's tag, the SHA-1 of its siblings in sorted order;
+	merge.lua keeps both up to date as records change. The buckets are the
+	leaves of a tree whose inner nodes are their hex prefixes, each summing
+	its children, so two regions holding the same records agree on every
+	digest.
+
+	A sync round walks the tree down from the root against a peer a level at
+	a time, only descending where the digests differ. Each level costs one
+	request, as do the key lists of the divergent buckets and each batch of
+	records, so a round costs one request when the regions agree and grows
+	with the number of divergent buckets rather than with the number of
+	keys. The keys whose tags differ are pulled from the peer and merged
+	with the same clock rules as any write; the peer pulls whatever it lacks
+	on its own round.
+
+	A region is anything with digests(prefixes), keys(buckets) and
+	records(keys); the local one also needs merge(key, choices, clocks).
+	Peer reaches another region's server over HTTP, and checks every reply
+	before it is used: a record pulled from a peer must hold ratings and
+	clocks a PUT could have stored.
+
+	There are no tombstones: a record deleted in one region comes back from
+	any peer still holding it on the next round.
+'''
+
+import json
+import hashlib
+import threading
+import redis
+import requests
+
+import codec
+
+# Hex digits of the key hash that pick its bucket, and most records pulled
+# with one request
+DEPTH = 3
+BATCH = 500
+
+# Every shard's hash of bucket => digest, and hashes of key => tag per bucket
+DIGEST = '/antientropy/digest'
+BUCKET = '/antientropy/bucket/'
+
+class PeerError(ValueError):
+	pass
+
+def bucket(key):
+	"""The bucket key falls in."""
+	return hashlib.sha1(key).hexdigest()[:DEPTH]
+
+def leaf(key, tag):
+	"""What key contributes to its bucket's digest while its tag is tag."""
+	return int(hashlib.sha1(key + tag).hexdigest()[:12], 16)
+
+def children(leaves, prefixes):
+	"""Digests of the children of every prefix in prefixes, given the digest
+	of every bucket; empty ones are left out."""
+	result = { }
+	for prefix in prefixes:
+		for name, total in leaves.iteritems():
+			if name.startswith(prefix) and total:
+				child = name[:len(prefix)+1]
+				result[child] = result.get(child, 0) + total
+	return result
+
+def differing(mine, theirs):
+	"""The tree nodes whose digests differ between two regions, in order."""
+	return sorted(child for child in set(mine) | set(theirs) if mine.get(child, 0) != theirs.get(child, 0))
+
+def wanted(mine, theirs):
+	"""Keys that the peer holds differently, given key => tag in both
+	regions."""
+	return sorted(key for key, tag in theirs.iteritems() if mine.get(key) != tag)
+
+def sync(local, peer, stats):
+	"""Pull into local every record peer holds differently, merging it with
+	what local holds. Counts the tree nodes compared, divergent buckets and
+	records pulled in stats."""
+	level = [ '' ]
+	# A peer with another DEPTH, or a broken one, may answer with nodes that
+	# are not children of those asked for; they are ignored, so the descent
+	# ends after DEPTH levels whatever the peer says
+	for _ in range(DEPTH):
+		stats['nodes'] += len(level)
+		parents = set(level)
+		level = [ child for child in differing(local.digests(level), peer.digests(level)) if child[:-1] in parents ]
+		if not level: return
+	stats['buckets'] += len(level)
+	keys = wanted(local.keys(level), peer.keys(level))
+	for i in range(0, len(keys), BATCH):
+		for key, (choices, clocks) in sorted(peer.records(keys[i:i+BATCH]).iteritems()):
+			local.merge(key, choices, clocks)
+			stats['pulled'] += 1
+
+class Peer(object):
+	"""Another region, reached through the anti-entropy routes of its server
+	at url"""
+
+	def __init__(self, url, timeout=5.0):
+		self.url = url.rstrip('/')
+		self.timeout = timeout
+		self.session = requests.Session()
+
+	def _call(self, method, path, **kwargs):
+		reply = self.session.request(method, self.url+path, timeout=self.timeout, **kwargs)
+		reply.raise_for_status()
+		return reply.json()
+
+	def _post(self, path, data):
+		return self._call('POST', path, data=json.dumps(data), headers={ 'Content-Type': 'application/json' })
+
+	def digests(self, prefixes):
+		digests = _object(self._call('GET', '/antientropy/digest', params={ 'prefix': prefixes }))
+		if not all(isinstance(child, basestring) and isinstance(total, (int, long)) for child, total in digests.iteritems()):
+			raise PeerError("Malformed digests")
+		return digests
+
+	def keys(self, buckets):
+		tags = _object(self._post('/antientropy/keys', { 'buckets': buckets }))
+		if not all(isinstance(key, basestring) and isinstance(tag, basestring) for key, tag in tags.iteritems()):
+			raise PeerError("Malformed key list")
+		return tags
+
+	def records(self, keys):
+		asked, result = set(keys), { }
+		for key, record in _object(self._post('/antientropy/records', { 'keys': keys })).iteritems():
+			if key not in asked:
+				raise PeerError("Record %r was not asked for" % key)
+			choices, clocks = _object(record).get('choices'), record.get('clocks')
+			if not isinstance(choices, list) or not isinstance(clocks, list) or len(choices) != len(clocks):
+				raise PeerError("Malformed record %r" % key)
+			try:
+				pairs = [ codec.check(rating, clock) for rating, clock in zip(choices, clocks) ]
+			except codec.CodecError as e:
+				raise PeerError("Record %r: %s" % (key, e))
+			result[key] = [ rating for rating, _ in pairs ], [ clock for _, clock in pairs ]
+		return result
+
+def _object(reply):
+	"""reply, if it is a JSON object; a peer answering anything else is
+	broken."""
+	if not isinstance(reply, dict):
+		raise PeerError("Expected an object, got %r" % (reply,))
+	return reply
+
+class AntiEntropy(object):
+	def __init__(self, local, peers, interval=1.0):
+		self.local = local
+		self.peers = list(peers)
+		self.interval = interval
+		self.lock = threading.Lock()  # one round at a time
+		self.stopped = threading.Event()
+		self.thread = None
+		self.stats = { 'rounds': 0, 'nodes': 0, 'buckets': 0, 'pulled': 0, 'errors': 0 }
+
+	def round(self):
+		"""Sync with every peer once; a peer that cannot be reached or
+		answers with garbage, or a failed local merge, is counted and tried
+		again next round."""
+		with self.lock:
+			for peer in self.peers:
+				try:
+					sync(self.local, peer, self.stats)
+				except (IOError, ValueError, KeyError, redis.RedisError):
+					self.stats['errors'] += 1
+			self.stats['rounds'] += 1
+			return dict(self.stats)
+
+	def start(self):
+		"""Run a round every interval seconds from a background thread."""
+		def loop():
+			while not self.stopped.wait(self.interval):
+				# Whatever goes wrong in one round, the next still runs
+				try:
+					self.round()
+				except Exception:
+					with self.lock:
+						self.stats['errors'] += 1
+		self.thread = threading.Thread(target=loop)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.stopped.set()
+		if self.thread:
+			self.thread.join()
+
+# -----------IGNOREBEYOND: test code ---------------
+import time
+import unittest
+from writebuffer import merge
+
+
+class Region(object):
+	"""A region held in memory, merging with writebuffer.merge"""
+
+	def __init__(self):
+		self.held = { }  # key => (choices, clocks)
+		self.leaves = { }
+		self.tags = { }
+		self.requests = self.pulls = 0
+
+	def put(self, key, rating, clock):
+		self.merge(key, [rating], [clock])
+
+	def merge(self, key, choices, clocks):
+		current = self.held.get(key, ([], []))
+		for rating, clock in zip(choices, clocks):
+			current = merge(current[0], current[1], rating, clock) or current
+		tag = hashlib.sha1(repr(sorted(zip(current[0], [ sorted(clock.items()) for clock in current[1] ])))).hexdigest()
+		name = bucket(key)
+		self.leaves[name] = self.leaves.get(name, 0) + leaf(key, tag) - (leaf(key, self.tags[key]) if key in self.tags else 0)
+		self.held[key], self.tags[key] = current, tag
+
+	def digests(self, prefixes):
+		self.requests += 1
+		return children(self.leaves, prefixes)
+
+	def keys(self, buckets):
+		self.requests += 1
+		return dict((key, tag) for key, tag in self.tags.iteritems() if bucket(key) in buckets)
+
+	def records(self, keys):
+		self.requests += 1
+		self.pulls += len(keys)
+		return dict((key, self.held[key]) for key in keys)
+
+
+class AntiEntropyTestCase(unittest.TestCase):
+	"""Test digests and sync rounds between regions"""
+
+	def setUp(self):
+		self.a, self.b = Region(), Region()
+		for i in range(500):
+			for region in (self.a, self.b):
+				region.put('/rating/e%d' % i, 3.0, { 'c0': 1 })
+		self.stats = { 'nodes': 0, 'buckets': 0, 'pulled': 0 }
+
+	def testDigests(self):
+		self.assertEquals(self.a.digests(['']), self.b.digests(['']))
+		self.assertEquals(sum(children(self.a.leaves, ['']).values()), sum(self.a.leaves.values()))
+		self.assertEquals(sorted(children(self.a.leaves, ['a', 'b'])), sorted(set(name[:2] for name in self.a.leaves if name[0] in 'ab')))
+		self.assertEquals(differing({ 'a': 1, 'b': 2 }, { 'b': 3, 'c': 0 }), ['a', 'b'])
+		self.assertEquals(wanted({ 'x': 't1', 'y': 't2' }, { 'x': 't1', 'y': 't3', 'z': 't4' }), ['y', 'z'])
+
+	def testInSync(self):
+		sync(self.a, self.b, self.stats)
+		self.assertEquals(self.stats, { 'nodes': 1, 'buckets': 0, 'pulled': 0 })
+		self.assertEquals(self.b.requests, 1)
+
+	def testDivergence(self):
+		self.a.put('/rating/e7', 5.0, { 'c0': 2 })
+		self.b.put('/rating/e7', 1.0, { 'c1': 1 })
+		self.b.put('/rating/new', 4.0, { 'c2': 1 })
+		sync(self.a, self.b, self.stats)
+		self.assertEquals((self.stats['pulled'], self.b.pulls), (2, 2))
+		self.assertEquals(self.stats['buckets'], 2)
+		self.assertEquals(self.b.requests, DEPTH+2)
+		self.assertEquals(self.a.held['/rating/e7'], ([5.0, 1.0], [{ 'c0': 2 }, { 'c1': 1 }]))
+		self.assertEquals(self.a.held['/rating/new'], ([4.0], [{ 'c2': 1 }]))
+		# b pulls the sibling it lacks and the two then agree, although they
+		# hold the siblings in a different order
+		sync(self.b, self.a, self.stats)
+		self.assertEquals(self.b.held['/rating/e7'], ([1.0, 5.0], [{ 'c1': 1 }, { 'c0': 2 }]))
+		self.assertEquals(self.a.digests(['']), self.b.digests(['']))
+		self.stats['pulled'] = 0
+		sync(self.a, self.b, self.stats)
+		self.assertEquals(self.stats['pulled'], 0)
+
+	def testBatches(self):
+		for i in range(BATCH+1):
+			self.b.put('/rating/f%d' % i, 1.0, { 'c1': 1 })
+		sync(self.a, self.b, self.stats)
+		self.assertEquals(self.stats['pulled'], BATCH+1)
+		self.assertEquals(self.b.requests, DEPTH+3)
+		self.assertEquals(self.a.digests(['']), self.b.digests(['']))
+
+	def testForeignTree(self):
+		class Flat(Region):
+			# Answers with the same node whatever it is asked for
+			def digests(self, prefixes):
+				self.requests += 1
+				return { 'f': 1 }
+		peer = Flat()
+		sync(self.a, peer, self.stats)
+		self.assertEquals(peer.requests, DEPTH+1)
+		self.assertTrue(self.stats['nodes'] <= sum(16**depth for depth in range(DEPTH)))
+		self.assertEquals(self.stats['pulled'], 0)
+
+	def testUnreachable(self):
+		class Down(object):
+			def digests(self, prefixes):
+				raise IOError('unreachable')
+		entropy = AntiEntropy(self.a, [ Down(), self.b ])
+		stats = entropy.round()
+		self.assertEquals((stats['rounds'], stats['errors'], stats['pulled']), (1, 1, 0))
+
+	def testGarbage(self):
+		# Peers whose servers answer with the wrong JSON
+		class Reply(object):
+			def __init__(self, data):
+				self.data = data
+			def raise_for_status(self):
+				pass
+			def json(self):
+				return self.data
+		class Garbage(object):
+			def __init__(self, answers):
+				self.answers = answers  # route => answer given the request
+			def request(self, method, url, **kwargs):
+				return Reply(self.answers[url.rsplit('/', 1)[-1]](kwargs))
+		def serving(record):
+			# A peer holding /rating/new, which it sends as record
+			peer = Peer('http://peer')
+			peer.session = Garbage({
+				'digest': lambda kwargs: self.b.digests(kwargs['params']['prefix']),
+				'keys': lambda kwargs: { '/rating/new': 'tag' },
+				'records': lambda kwargs: { '/rating/new': record }
+			})
+			return peer
+		self.b.put('/rating/new', 4.0, { 'c2': 1 })
+		peers = [ Peer('http://peer') for _ in range(3) ]
+		peers[0].session = Garbage({ 'digest': lambda kwargs: { '': 'junk' } })
+		peers[1].session = Garbage({ 'digest': lambda kwargs: [ 'a', 'b' ] })
+		peers[2].session = Garbage({ 'digest': lambda kwargs: self.b.digests(kwargs['params']['prefix']), 'keys': lambda kwargs: [ ] })
+		peers += [ serving(record) for record in (
+			{ 'rating': 4.0 },
+			{ 'choices': '4', 'clocks': '{}' },
+			{ 'choices': [ 4.0, 5.0 ], 'clocks': [ { 'c2': 1 } ] },
+			{ 'choices': [ float('nan') ], 'clocks': [ { 'c2': 1 } ] },
+			{ 'choices': [ 1.7e308 ], 'clocks': [ { 'c2': 1 } ] },
+			{ 'choices': [ 4.0 ], 'clocks': [ { 'c2': 2**53 + 1 } ] },
+			{ 'choices': [ 4.0 ], 'clocks': [ [ 'c2', 1 ] ] },
+			[ 4.0 ]
+		) ]
+		entropy = AntiEntropy(self.a, peers)
+		stats = entropy.round()
+		self.assertEquals((stats['rounds'], stats['errors'], stats['pulled']), (1, len(peers), 0))
+		self.assertFalse('/rating/new' in self.a.held)
+		entropy.peers.append(serving({ 'choices': [ 4 ], 'clocks': [ { 'c2': 1 } ] }))
+		stats = entropy.round()
+		self.assertEquals((stats['rounds'], stats['errors'], stats['pulled']), (2, 2*len(peers), 1))
+		self.assertEquals(self.a.held['/rating/new'], ([4.0], [{ 'c2': 1 }]))
+
+	def testLoopSurvives(self):
+		class Broken(object):
+			def digests(self, prefixes):
+				raise TypeError('broken')
+		entropy = AntiEntropy(self.a, [ Broken() ], interval=0.01).start()
+		while entropy.stats['errors'] < 2:
+			time.sleep(0.01)
+		entropy.stop()
+		self.assertFalse(entropy.thread.is_alive())
+
+
+if __name__ == "__main__":
+	unittest.main()
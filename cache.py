@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+	Version-validated LRU cache
+
+	Every value is stored with the version of the record it was read from.
+	A lookup asks for the record's current version and only returns the
+	value if the two still match, so writers in other processes never leave
+	a reader with stale data; they just cause a miss.
+'''
+
+import threading
+from collections import OrderedDict
+
+class VersionedCache(object):
+	def __init__(self, size=10000):
+		self.size = size
+		self.entries = OrderedDict()  # key => (version, value), oldest first
+		self.lock = threading.Lock()
+		self.stats = { 'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0 }
+
+	def get(self, key, version):
+		"""Return the value cached for key if it was read at the version
+		version() reports now, otherwise None. version is only called when
+		something is cached for key."""
+		with self.lock:
+			entry = self.entries.get(key)
+		if entry is None:
+			with self.lock:
+				self.stats['misses'] += 1
+			return None
+		current = version()
+		with self.lock:
+			if current is not None and current == entry[0]:
+				self.stats['hits'] += 1
+				if key in self.entries:
+					self.entries[key] = self.entries.pop(key)
+				return entry[1]
+			self.stats['misses'] += 1
+			self.stats['stale'] += 1
+			if self.entries.get(key) is entry:
+				del self.entries[key]
+			return None
+
+	def put(self, key, version, value):
+		"""Cache value as read at version, evicting the least recently used
+		entries beyond size."""
+		with self.lock:
+			self.entries.pop(key, None)
+			self.entries[key] = (version, value)
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+				self.stats['evictions'] += 1
+
+	def discard(self, key):
+		with self.lock:
+			self.entries.pop(key, None)
+
+# -----------IGNOREBEYOND: test code ---------------
+import unittest
+
+
+class VersionedCacheTestCase(unittest.TestCase):
+	"""Test the versioned cache"""
+
+	def setUp(self):
+		self.cache = VersionedCache(size=2)
+		self.versions = { }
+
+	def version(self, key):
+		return lambda: self.versions.get(key)
+
+	def testHitAndStale(self):
+		self.assertEquals(self.cache.get('bob', self.version('bob')), None)
+		self.versions['bob'] = '1'
+		self.cache.put('bob', '1', 'five')
+		self.assertEquals(self.cache.get('bob', self.version('bob')), 'five')
+		self.versions['bob'] = '2'
+		self.assertEquals(self.cache.get('bob', self.version('bob')), None)
+		self.assertEquals(self.cache.get('bob', self.version('bob')), None)
+		self.assertEquals(self.cache.stats, { 'hits': 1, 'misses': 3, 'stale': 1, 'evictions': 0 })
+
+	def testDeletedRecord(self):
+		self.cache.put('bob', '1', 'five')
+		self.assertEquals(self.cache.get('bob', self.version('bob')), None)
+
+	def testEviction(self):
+		for key in ('a', 'b', 'c'):
+			self.versions[key] = '1'
+		self.cache.put('a', '1', 'A')
+		self.cache.put('b', '1', 'B')
+		self.cache.get('a', self.version('a'))
+		self.cache.put('c', '1', 'C')
+		self.assertEquals(self.cache.get('b', self.version('b')), None)
+		self.assertEquals(self.cache.get('a', self.version('a')), 'A')
+		self.assertEquals(self.cache.stats['evictions'], 1)
+		self.cache.discard('a')
+		self.assertEquals(self.cache.get('a', self.version('a')), None)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+'''
+	Compact binary encoding of an entity's sibling set
+
+	A sibling set is the pair of parallel lists (choices, clocks) stored for
+	an entity: the incomparable ratings and the vector clock of each, with
+	clocks given as dictionaries of node => counter.
+
+	Layout, every integer an unsigned LEB128 varint:
+
+		'S' VERSION
+		node count, then each node name as length + UTF-8 bytes, sorted
+		sibling count, then for each sibling:
+			entry count << 1 | text
+			rating as a zigzag varint, or as length + '%.17g' text if text
+			entry count pairs of (node index, counter), in node index order
+
+	Only whole ratings below 2**53 in magnitude are varints; merge.lua reads
+	varints as doubles, which are exact up to there and overflow far beyond
+	it. For the same reason clock counters must be below 2**53: a larger one
+	would come back from merge.lua as a different counter.
+
+	merge.lua reads and writes the same layout; keep the two in step.
+'''
+
+import math
+
+MAGIC = 'S'
+VERSION = 1
+
+# Whole ratings below this in magnitude are stored as varints, and clock
+# counters must be below it
+EXACT = 2**53
+
+class CodecError(ValueError):
+	pass
+
+def _varint(out, n):
+	while n >= 0x80:
+		out.append((n & 0x7f) | 0x80)
+		n >>= 7
+	out.append(n)
+
+def _text(out, s):
+	_varint(out, len(s))
+	out.extend(s)
+
+def check(rating, clock):
+	"""Return a (rating, clock) pair as it may be stored, with the rating as
+	a float, or raise CodecError. Ratings must be finite and below EXACT in
+	magnitude, clocks dictionaries of node name => counter below EXACT."""
+	if isinstance(rating, (int, long)) and abs(rating) < EXACT:
+		rating = float(rating)
+	# NaN and the infinities poison the mean, and ratings this large no
+	# longer hold whole numbers exactly
+	if not isinstance(rating, float) or math.isnan(rating) or math.isinf(rating) or abs(rating) >= EXACT:
+		raise CodecError("Invalid rating %r" % (rating,))
+	if not isinstance(clock, dict):
+		raise CodecError("Invalid clock %r" % (clock,))
+	for node, counter in clock.iteritems():
+		if not isinstance(node, basestring) or not isinstance(counter, (int, long)) or not 0 <= counter < EXACT:
+			raise CodecError("Node %r has invalid count %r" % (node, counter))
+	return rating, clock
+
+def pack(choices, clocks):
+	"""Encode parallel lists of ratings and clock dictionaries into a blob."""
+	if len(choices) != len(clocks):
+		raise CodecError("%d choices but %d clocks" % (len(choices), len(clocks)))
+	names = sorted(set(node for clock in clocks for node in clock))
+	index = dict((node, i) for i, node in enumerate(names))
+
+	out = bytearray(MAGIC)
+	out.append(VERSION)
+	_varint(out, len(names))
+	for node in names:
+		_text(out, node.encode('utf-8'))
+	_varint(out, len(choices))
+	for rating, clock in zip(choices, clocks):
+		# NaN and the infinities fail the range check before int() sees them
+		text = not abs(rating) < EXACT or rating != int(rating)
+		_varint(out, len(clock) << 1 | text)
+		if text:
+			_text(out, '%.17g' % rating)
+		else:
+			rating = int(rating)
+			_varint(out, rating << 1 if rating >= 0 else (-rating << 1) - 1)
+		for i, node in sorted((index[node], node) for node in clock):
+			counter = clock[node]
+			if not isinstance(counter, (int, long)) or not 0 <= counter < EXACT:
+				raise CodecError("Node %s has invalid count %r" % (node, counter))
+			_varint(out, i)
+			_varint(out, counter)
+	return bytes(out)
+
+def unpack(blob):
+	"""Decode a blob produced by pack() into (choices, clocks)."""
+	data = bytearray(blob)
+	if data[:1] != MAGIC or len(data) < 2:
+		raise CodecError("Not a sibling set")
+	if data[1] != VERSION:
+		raise CodecError("Unsupported sibling set version %d" % data[1])
+	pos = [2]
+
+	def varint():
+		n = shift = 0
+		while True:
+			try:
+				b = data[pos[0]]
+			except IndexError:
+				raise CodecError("Truncated sibling set")
+			pos[0] += 1
+			n |= (b & 0x7f) << shift
+			if b < 0x80:
+				return n
+			shift += 7
+
+	def text():
+		length = varint()
+		start = pos[0]
+		pos[0] += length
+		if pos[0] > len(data):
+			raise CodecError("Truncated sibling set")
+		return bytes(data[start:pos[0]])
+
+	names = [text().decode('utf-8') for _ in xrange(varint())]
+	choices, clocks = [], []
+	for _ in xrange(varint()):
+		header = varint()
+		if header & 1:
+			rating = float(text())
+		else:
+			z = varint()
+			rating = float(z >> 1 if not z & 1 else -((z + 1) >> 1))
+		clock = {}
+		for _ in xrange(header >> 1):
+			node = varint()
+			clock[names[node]] = varint()
+		choices.append(rating)
+		clocks.append(clock)
+	return choices, clocks
+
+# -----------IGNOREBEYOND: test code ---------------
+import unittest
+
+
+class CodecTestCase(unittest.TestCase):
+	"""Test sibling set encoding"""
+
+	def testRoundTrip(self):
+		choices = [5.0, -2.0, 3.25, 0.0]
+		clocks = [{ 'c0': 22 }, { 'c5': 40 }, { 'c3': 91, 'c5': 37 }, {}]
+		self.assertEquals(unpack(pack(choices, clocks)), (choices, clocks))
+
+	def testLargeCounters(self):
+		clocks = [{ 'c0': 2**40, u'n\xe9': 127, 'c1': 128 }]
+		self.assertEquals(unpack(pack([1.0], clocks)), ([1.0], clocks))
+
+	def testCompact(self):
+		clocks = [{ 'c0': 3, 'c1': 2 }, { 'c0': 1, 'c6': 9 }]
+		self.assertEquals(len(pack([5.0, 4.0], clocks)), 25)
+
+	def testExtremes(self):
+		choices = [EXACT - 1.0, 1.0 - EXACT, float(EXACT), -float(EXACT), 1.7e308, -1.7e308, 5e-324]
+		clocks = [{ 'c0': 1 }] * len(choices)
+		self.assertEquals(unpack(pack(choices, clocks)), (choices, clocks))
+		# Past 2**53 the rating goes as text, not as a varint of 1024 bits
+		self.assertEquals(len(pack([1.7e308], [{}])), 29)
+		self.assertEquals(len(pack([EXACT - 1.0], [{}])), 13)
+
+	def testCheck(self):
+		self.assertEquals(check(5, { 'c0': 1 }), (5.0, { 'c0': 1 }))
+		self.assertEquals(check(EXACT - 1.0, { u'c\xe9': EXACT - 1 }), (EXACT - 1.0, { u'c\xe9': EXACT - 1 }))
+		for rating in (float('nan'), float('inf'), float('-inf'), 1.7e308, -float(EXACT), EXACT, 10**400, '5', None, [5.0]):
+			self.assertRaises(CodecError, check, rating, { 'c0': 1 })
+		for clock in (None, [], { 'c0': -1 }, { 'c0': EXACT }, { 'c0': 1.5 }, { 'c0': '1' }, { 1: 1 }):
+			self.assertRaises(CodecError, check, 5.0, clock)
+
+	def testErrors(self):
+		self.assertRaises(CodecError, pack, [1.0], [])
+		self.assertRaises(CodecError, pack, [1.0], [{ 'c0': -1 }])
+		# merge.lua would read these back as 2**53 and 2**62
+		self.assertRaises(CodecError, pack, [1.0], [{ 'c0': EXACT }])
+		self.assertRaises(CodecError, pack, [1.0], [{ 'c0': 2**62 + 1 }])
+		self.assertEquals(unpack(pack([1.0], [{ 'c0': EXACT - 1 }])), ([1.0], [{ 'c0': EXACT - 1 }]))
+		self.assertRaises(CodecError, unpack, '[5.0]')
+		self.assertRaises(CodecError, unpack, 'S\x02')
+		self.assertRaises(CodecError, unpack, pack([1.0], [{ 'c0': 300 }])[:-1])
+
+
+if __name__ == "__main__":
+	unittest.main()
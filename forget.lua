@@ -0,0 +1,21 @@
+-- Delete an entity's record and take it out of its bucket's anti-entropy
+-- digest and key list in the same step (see merge.lua and antientropy.py).
+--
+-- KEYS[1]  the rating hash, e.g. /rating/bob
+-- KEYS[2]  the shard's anti-entropy digest hash, bucket => sum
+-- KEYS[3]  the hash of every key in the entity's bucket => its tag
+-- ARGV[1]  the entity's digest bucket
+--
+-- Returns the number of keys deleted, as DEL does.
+
+local key = KEYS[1]
+
+-- As in merge.lua
+local function leaf(tag) return tonumber(string.sub(redis.sha1hex(key .. tag), 1, 12), 16) end
+
+local old = redis.call('HGET', KEYS[3], key)
+if old then
+	redis.call('HINCRBY', KEYS[2], ARGV[1], string.format('%.0f', -leaf(old)))
+	redis.call('HDEL', KEYS[3], key)
+end
+return redis.call('DEL', key)
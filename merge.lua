@@ -0,0 +1,412 @@
+-- Merge incoming (rating, clock) pairs into the sibling set of an entity.
+--
+-- Runs inside Redis so the whole read-merge-write step is atomic and costs
+-- the caller one round trip (EVALSHA).
+--
+-- KEYS[1]  the rating hash, e.g. /rating/bob
+-- KEYS[2]  optional: the shard's anti-entropy digest hash, bucket => sum
+-- KEYS[3]  optional: the hash of every key in the entity's bucket => the
+--          SHA-1 of its siblings in sorted order
+-- ARGV[1]  the incoming pairs, as a sibling set packed by codec.py
+-- ARGV[2]  starting version, used if the record is new
+-- ARGV[3]  most siblings the entity may hold, or 0 for no limit
+-- ARGV[4]  what to do beyond the limit: 'fold' the oldest siblings into
+--          one, or 'reject' the new ones
+-- ARGV[5]  most nodes the clocks may hold before the least recently
+--          advanced are pruned, or 0 for no limit
+-- ARGV[6]  seconds after which a node that has not advanced is pruned,
+--          or 0 for no limit
+-- ARGV[7]  the time now, in seconds
+-- ARGV[8]  with KEYS[2], the entity's digest bucket
+--
+-- With pruning on, the time each node last advanced the entity's clocks is
+-- kept in the record's 'stamps' field.
+--
+-- The record's 'version' field is bumped in the same step as every write
+-- that changes it, its 'etag' field set to the SHA-1 of the packed sibling
+-- set (server.py serves it as the ETag of GET), and the running aggregates
+-- of the choices (see aggregates.py) are adjusted by the siblings added and
+-- dominated. With KEYS[2], the bucket's digest and key list are kept up to
+-- date too (see antientropy.py). They hash the siblings sorted rather than
+-- in the order they arrived, so that regions that took the same writes in a
+-- different order still agree.
+--
+-- Returns { mean rating of the entity as a '%.17g' string, which reads back
+-- as the same double, siblings folded, incoming pairs rejected, nodes
+-- pruned, 1 if pruning was put off, incoming pairs that were stale,
+-- incoming pairs that superseded siblings, siblings superseded, incoming
+-- pairs added as concurrent siblings, siblings the entity now holds, the
+-- record's version after the write (false if there is no record) }.
+
+local key = KEYS[1]
+
+-- Sibling set encoding; see codec.py for the layout.
+local MAGIC, VERSION = 'S', 1
+
+local function read_varint(s, pos)
+	local n, scale = 0, 1
+	while true do
+		local b = string.byte(s, pos)
+		if b == nil then error('truncated sibling set') end
+		pos = pos + 1
+		n = n + (b % 128) * scale
+		if b < 128 then return n, pos end
+		scale = scale * 128
+	end
+end
+
+local function write_varint(out, n)
+	-- inf would never drop below 128, and NaN would not be a whole number
+	if n ~= n or n < 0 or n == math.huge then error('cannot encode ' .. tostring(n) .. ' as a varint') end
+	while n >= 128 do
+		table.insert(out, string.char(n % 128 + 128))
+		n = math.floor(n / 128)
+	end
+	table.insert(out, string.char(n))
+end
+
+local function unpack_siblings(s)
+	if string.sub(s, 1, 1) ~= MAGIC or string.byte(s, 2) ~= VERSION then
+		error('unknown sibling set format')
+	end
+	local pos, count, len = 3
+	count, pos = read_varint(s, pos)
+	local nodes = {}
+	for i = 1, count do
+		len, pos = read_varint(s, pos)
+		nodes[i] = string.sub(s, pos, pos + len - 1)
+		pos = pos + len
+	end
+	local choices, clocks = {}, {}
+	count, pos = read_varint(s, pos)
+	for i = 1, count do
+		local header, rating, z
+		header, pos = read_varint(s, pos)
+		if header % 2 == 1 then
+			len, pos = read_varint(s, pos)
+			rating = tonumber(string.sub(s, pos, pos + len - 1))
+			pos = pos + len
+		else
+			z, pos = read_varint(s, pos)
+			if z % 2 == 0 then rating = z / 2 else rating = -(z + 1) / 2 end
+		end
+		local clock, node = {}
+		for j = 1, math.floor(header / 2) do
+			node, pos = read_varint(s, pos)
+			clock[nodes[node + 1]], pos = read_varint(s, pos)
+		end
+		choices[i], clocks[i] = rating, clock
+	end
+	return choices, clocks
+end
+
+local function pack_siblings(choices, clocks)
+	local names, index = {}, {}
+	for i = 1, #clocks do
+		for node in pairs(clocks[i]) do
+			if not index[node] then
+				index[node] = true
+				table.insert(names, node)
+			end
+		end
+	end
+	table.sort(names)
+	for i, node in ipairs(names) do index[node] = i - 1 end
+
+	local out = { MAGIC, string.char(VERSION) }
+	write_varint(out, #names)
+	for _, node in ipairs(names) do
+		write_varint(out, #node)
+		table.insert(out, node)
+	end
+	write_varint(out, #choices)
+	for i = 1, #choices do
+		local rating, clock, entries = choices[i], clocks[i], {}
+		for node in pairs(clock) do table.insert(entries, index[node]) end
+		table.sort(entries)
+		-- As codec.py: only whole ratings below 2^53 in magnitude, which
+		-- doubles hold exactly, are varints
+		if rating == math.floor(rating) and math.abs(rating) < 2^53 then
+			write_varint(out, #entries * 2)
+			if rating >= 0 then write_varint(out, rating * 2) else write_varint(out, -rating * 2 - 1) end
+		else
+			local text = string.format('%.17g', rating)
+			write_varint(out, #entries * 2 + 1)
+			write_varint(out, #text)
+			table.insert(out, text)
+		end
+		for _, j in ipairs(entries) do
+			write_varint(out, j)
+			write_varint(out, clock[names[j + 1]])
+		end
+	end
+	return table.concat(out)
+end
+
+-- Compare two clocks in a single pass over the union of their nodes.
+-- Returns 'equal', 'before' (a < b), 'after' (a > b) or 'concurrent'.
+local function compare(a, b)
+	local less, greater = false, false
+	for node, count in pairs(a) do
+		local other = b[node]
+		if other == nil or count > other then
+			greater = true
+		elseif count < other then
+			less = true
+		end
+		if less and greater then return 'concurrent' end
+	end
+	for node in pairs(b) do
+		if a[node] == nil then
+			less = true
+			if greater then return 'concurrent' end
+		end
+	end
+	if less then return 'before' end
+	if greater then return 'after' end
+	return 'equal'
+end
+
+-- One pass over the existing siblings: give up if the new clock is stale,
+-- otherwise keep only the siblings it does not dominate and add the new
+-- pair last, so siblings stay oldest first. Returns nil when the new pair
+-- is stale, else the new lists and the ratings dominated.
+local function merge(choices, clocks, rating, clock)
+	local new_choices, new_clocks, dropped = {}, {}, {}
+	for i = 1, #clocks do
+		local order = compare(clock, clocks[i])
+		if order == 'before' or order == 'equal' then
+			return nil
+		elseif order == 'after' then
+			table.insert(dropped, choices[i])
+		else
+			table.insert(new_choices, choices[i])
+			table.insert(new_clocks, clocks[i])
+		end
+	end
+	table.insert(new_choices, rating)
+	table.insert(new_clocks, clock)
+	return new_choices, new_clocks, dropped
+end
+
+-- Running aggregates, stored as count, sum, sumsq, min, max
+local function add(agg, r)
+	agg.count, agg.sum, agg.sumsq = agg.count + 1, agg.sum + r, agg.sumsq + r * r
+	if agg.min == nil or r < agg.min then agg.min = r end
+	if agg.max == nil or r > agg.max then agg.max = r end
+end
+
+-- Returns true if r was the minimum or maximum, which then need the
+-- survivors to be found again
+local function remove(agg, r)
+	agg.count, agg.sum, agg.sumsq = agg.count - 1, agg.sum - r, agg.sumsq - r * r
+	return r <= agg.min or r >= agg.max
+end
+
+local function aggregate(choices)
+	local agg = { count = 0, sum = 0, sumsq = 0 }
+	for i = 1, #choices do add(agg, choices[i]) end
+	return agg
+end
+
+-- Fold the oldest siblings into one, so that no more than limit are left:
+-- its clock is the converged (per-node maximum) clock of those folded and
+-- its rating their mean. It goes first, as the oldest, and any survivor it
+-- dominates is dropped. Returns the new lists and the ratings removed.
+local function fold(choices, clocks, limit)
+	local n = #choices - limit + 1
+	local rating, clock, removed = 0, {}, {}
+	for i = 1, n do
+		rating = rating + choices[i]
+		for node, count in pairs(clocks[i]) do
+			if clock[node] == nil or clock[node] < count then clock[node] = count end
+		end
+		table.insert(removed, choices[i])
+	end
+	rating = rating / n
+	local new_choices, new_clocks = { rating }, { clock }
+	for i = n + 1, #choices do
+		if compare(clock, clocks[i]) == 'after' then
+			table.insert(removed, choices[i])
+		else
+			table.insert(new_choices, choices[i])
+			table.insert(new_clocks, clocks[i])
+		end
+	end
+	return new_choices, new_clocks, removed, rating
+end
+
+-- Nodes to prune from the clocks: those whose stamp is older than age, then
+-- the least recently advanced beyond width. Nodes advanced by this write
+-- are never pruned.
+local function stale_nodes(stamps, advanced, width, age, now)
+	local nodes, pruned, kept = {}, {}, 0
+	for node, stamp in pairs(stamps) do
+		if advanced[node] then
+			kept = kept + 1
+		elseif age > 0 and now - stamp > age then
+			table.insert(pruned, node)
+		else
+			table.insert(nodes, node)
+			kept = kept + 1
+		end
+	end
+	if width > 0 and kept > width then
+		table.sort(nodes, function(a, b)
+			if stamps[a] ~= stamps[b] then return stamps[a] < stamps[b] end
+			return a < b
+		end)
+		for i = 1, math.min(kept - width, #nodes) do table.insert(pruned, nodes[i]) end
+	end
+	return pruned
+end
+
+-- The clocks without the given nodes, or nil if that would change how any
+-- two siblings order against each other
+local function prune(clocks, nodes)
+	local pruned = {}
+	for i = 1, #clocks do
+		pruned[i] = {}
+		for node, count in pairs(clocks[i]) do pruned[i][node] = count end
+		for _, node in ipairs(nodes) do pruned[i][node] = nil end
+	end
+	for i = 1, #pruned do
+		for j = i + 1, #pruned do
+			if compare(pruned[i], pruned[j]) ~= 'concurrent' then return nil end
+		end
+	end
+	return pruned
+end
+
+local stored = redis.call('HMGET', key, 'siblings', 'choices', 'clocks', 'version', 'count', 'sum', 'sumsq', 'min', 'max', 'stamps')
+local choices, clocks, legacy = {}, {}, false
+if stored[1] then
+	choices, clocks = unpack_siblings(stored[1])
+elseif stored[3] then
+	-- Record still in the old JSON layout; it is upgraded by this write
+	choices, clocks, legacy = cjson.decode(stored[2]), cjson.decode(stored[3]), true
+end
+
+local agg
+if stored[5] then
+	agg = { count = tonumber(stored[5]), sum = tonumber(stored[6]), sumsq = tonumber(stored[7]),
+	        min = tonumber(stored[8]), max = tonumber(stored[9]) }
+else
+	-- Record from before aggregates were kept; they are added by this write
+	agg = aggregate(choices)
+end
+
+local limit, policy = tonumber(ARGV[3]) or 0, ARGV[4]
+local width, age, now = tonumber(ARGV[5]) or 0, tonumber(ARGV[6]) or 0, tonumber(ARGV[7])
+local pruning = width > 0 or age > 0
+
+-- Highest counter of every node across the siblings, to tell which nodes a
+-- write advances
+local top, advanced = {}, {}
+if pruning then
+	for i = 1, #clocks do
+		for node, count in pairs(clocks[i]) do
+			if (top[node] or -1) < count then top[node] = count end
+		end
+	end
+end
+
+local changed, extremes, folded, rejected = false, false, 0, 0
+local stale, superseding, superseded, concurrent = 0, 0, 0, 0
+local in_choices, in_clocks = unpack_siblings(ARGV[1])
+for i = 1, #in_choices do
+	local rating = in_choices[i]
+	local new_choices, new_clocks, dropped = merge(choices, clocks, rating, in_clocks[i])
+	if not new_choices then
+		stale = stale + 1
+	elseif policy == 'reject' and limit > 0 and #new_choices > limit and #new_choices > #choices then
+		rejected = rejected + 1
+	else
+		if #dropped > 0 then
+			superseding, superseded = superseding + 1, superseded + #dropped
+		else
+			concurrent = concurrent + 1
+		end
+		choices, clocks, changed = new_choices, new_clocks, true
+		add(agg, rating)
+		for _, r in ipairs(dropped) do
+			if remove(agg, r) then extremes = true end
+		end
+		if pruning then
+			for node, count in pairs(in_clocks[i]) do
+				if (top[node] or -1) < count then top[node], advanced[node] = count, true end
+			end
+		end
+	end
+end
+
+if changed and policy == 'fold' and limit > 0 and #choices > limit then
+	local removed, rating
+	choices, clocks, removed, rating = fold(choices, clocks, limit)
+	for _, r in ipairs(removed) do
+		if remove(agg, r) then extremes = true end
+	end
+	add(agg, rating)
+	folded = #removed
+end
+
+local stamps, pruned, deferred = nil, 0, 0
+if changed and pruning then
+	-- Stamp the nodes this write advanced, and any from before pruning was
+	-- turned on, then forget the nodes no clock holds any more
+	local old = stored[10] and cjson.decode(stored[10]) or {}
+	stamps = {}
+	for i = 1, #clocks do
+		for node in pairs(clocks[i]) do
+			stamps[node] = (not advanced[node] and old[node]) or now
+		end
+	end
+	local nodes = stale_nodes(stamps, advanced, width, age, now)
+	if #nodes > 0 then
+		local new_clocks = prune(clocks, nodes)
+		if new_clocks then
+			clocks, pruned = new_clocks, #nodes
+			for _, node in ipairs(nodes) do stamps[node] = nil end
+		else
+			-- Put off until later writes have converged the siblings
+			deferred = 1
+		end
+	end
+end
+
+local version = tonumber(stored[4])
+if changed then
+	if extremes then
+		-- A dominated sibling held the minimum or maximum; only then are
+		-- the survivors looked at again
+		local fresh = aggregate(choices)
+		agg.min, agg.max = fresh.min, fresh.max
+	end
+	version = (version or tonumber(ARGV[2]) or 0) + 1
+	local function num(n) return string.format('%.17g', n) end
+	local packed = pack_siblings(choices, clocks)
+	local fields = { 'siblings', packed, 'version', num(version), 'etag', redis.sha1hex(packed),
+		'count', agg.count, 'sum', num(agg.sum), 'sumsq', num(agg.sumsq), 'min', num(agg.min), 'max', num(agg.max) }
+	if stamps then
+		table.insert(fields, 'stamps')
+		table.insert(fields, cjson.encode(stamps))
+	end
+	redis.call('HMSET', key, unpack(fields))
+	if legacy then redis.call('HDEL', key, 'rating', 'choices', 'clocks') end
+	if KEYS[2] then
+		-- A bucket's digest is the sum of a number drawn from the SHA-1 of
+		-- each of its keys with its tag, so it moves by the difference
+		local function leaf(tag) return tonumber(string.sub(redis.sha1hex(key .. tag), 1, 12), 16) end
+		local parts = {}
+		for i = 1, #choices do parts[i] = pack_siblings({ choices[i] }, { clocks[i] }) end
+		table.sort(parts)
+		local tag = redis.sha1hex(table.concat(parts))
+		local old = redis.call('HGET', KEYS[3], key)
+		local delta = leaf(tag) - (old and leaf(old) or 0)
+		redis.call('HINCRBY', KEYS[2], ARGV[8], string.format('%.0f', delta))
+		redis.call('HSET', KEYS[3], key, tag)
+	end
+end
+
+return { string.format('%.17g', agg.sum / agg.count), folded, rejected, pruned, deferred,
+	stale, superseding, superseded, concurrent, #choices, version or false }
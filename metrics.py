@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+'''
+	Counters and histograms in the Prometheus text format
+
+	A Registry holds named metrics; each is broken down by labels given as
+	keyword arguments when it is updated. render() writes them all out in
+	the plain text exposition format, which any Prometheus-compatible
+	scraper can read.
+'''
+
+import bisect
+import threading
+
+# Default histogram buckets, for latencies in seconds
+LATENCY = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+def _labels(labels, **extra):
+	pairs = sorted(labels) + sorted(extra.iteritems())
+	if not pairs:
+		return ''
+	return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs)
+
+def _number(value):
+	if value == float('inf'):
+		return '+Inf'
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(object):
+	kind = 'counter'
+
+	def __init__(self, name, help):
+		self.name = name
+		self.help = help
+		self.values = { }  # label pairs => total
+		self.lock = threading.Lock()
+
+	def inc(self, amount=1, **labels):
+		key = tuple(sorted(labels.iteritems()))
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+	def lines(self):
+		with self.lock:
+			values = sorted(self.values.iteritems())
+		return [ '%s%s %s' % (self.name, _labels(key), _number(value)) for key, value in values ]
+
+class Histogram(object):
+	kind = 'histogram'
+
+	def __init__(self, name, help, buckets=LATENCY):
+		self.name = name
+		self.help = help
+		self.buckets = tuple(buckets)
+		self.values = { }  # label pairs => (count per bucket and one for +Inf, sum)
+		self.lock = threading.Lock()
+
+	def observe(self, value, **labels):
+		key = tuple(sorted(labels.iteritems()))
+		i = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			counts, total = self.values.get(key) or ([0]*(len(self.buckets)+1), 0)
+			counts[i] += 1
+			self.values[key] = (counts, total + value)
+
+	def lines(self):
+		with self.lock:
+			values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.iteritems())
+		lines = [ ]
+		for key, (counts, total) in values:
+			cumulative = 0
+			for bound, count in zip(self.buckets + (float('inf'),), counts):
+				cumulative += count
+				lines.append('%s_bucket%s %d' % (self.name, _labels(key, le=_number(bound)), cumulative))
+			lines.append('%s_sum%s %s' % (self.name, _labels(key), _number(total)))
+			lines.append('%s_count%s %d' % (self.name, _labels(key), cumulative))
+		return lines
+
+class Registry(object):
+	def __init__(self):
+		self.metrics = [ ]
+
+	def counter(self, name, help):
+		self.metrics.append(Counter(name, help))
+		return self.metrics[-1]
+
+	def histogram(self, name, help, buckets=LATENCY):
+		self.metrics.append(Histogram(name, help, buckets))
+		return self.metrics[-1]
+
+	def render(self):
+		"""All the metrics in the text exposition format."""
+		lines = [ ]
+		for metric in self.metrics:
+			lines.append('# HELP %s %s' % (metric.name, metric.help))
+			lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+			lines.extend(metric.lines())
+		return '\n'.join(lines) + '\n'
+
+# -----------IGNOREBEYOND: test code ---------------
+import unittest
+
+
+class MetricsTestCase(unittest.TestCase):
+	"""Test metric rendering"""
+
+	def setUp(self):
+		self.registry = Registry()
+
+	def testCounter(self):
+		merges = self.registry.counter('merges_total', 'Pairs merged')
+		merges.inc(outcome='stale')
+		merges.inc(2, outcome='stale')
+		merges.inc(outcome='concurrent')
+		self.assertEquals(self.registry.render(), '\n'.join([
+			'# HELP merges_total Pairs merged',
+			'# TYPE merges_total counter',
+			'merges_total{outcome="concurrent"} 1',
+			'merges_total{outcome="stale"} 3',
+		]) + '\n')
+
+	def testHistogram(self):
+		siblings = self.registry.histogram('siblings', 'Siblings', buckets=(1, 2, 4))
+		for count in (1, 1, 3, 9):
+			siblings.observe(count)
+		self.assertEquals(self.registry.render().splitlines()[2:], [
+			'siblings_bucket{le="1"} 2',
+			'siblings_bucket{le="2"} 2',
+			'siblings_bucket{le="4"} 3',
+			'siblings_bucket{le="+Inf"} 4',
+			'siblings_sum 14',
+			'siblings_count 4',
+		])
+
+	def testLabels(self):
+		latency = self.registry.histogram('seconds', 'Latency', buckets=(0.5,))
+		latency.observe(0.25, route='GET /rating/<entity>')
+		self.assertEquals(self.registry.render().splitlines()[2], 'seconds_bucket{route="GET /rating/<entity>",le="0.5"} 1')
+
+
+if __name__ == "__main__":
+	unittest.main()
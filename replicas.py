@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+'''
+	Health-aware round-robin over the read replicas of a shard
+
+	Reads take the replicas in turn. A replica that could not be reached is
+	marked down and skipped for retry seconds, after which it is tried
+	again; when every replica is down, reads go to the primary. Writes never
+	come through here.
+
+	Replicas lag their primary, so a read may miss the latest writes; the
+	server checks the record's version when a client asks to see its own.
+'''
+
+import time
+import threading
+
+class ReadPool(object):
+	def __init__(self, primary, replicas=(), retry=5.0):
+		self.primary = primary
+		self.replicas = list(replicas)
+		self.retry = retry
+		self.down = { }  # replica index => time it may be tried again
+		self.turn = 0
+		self.lock = threading.Lock()
+		self.stats = { 'replica': 0, 'primary': 0, 'failures': 0, 'behind': 0 }
+
+	def next(self):
+		"""The client to read from next: the next healthy replica in turn, or
+		the primary if there are none."""
+		now = time.time()
+		with self.lock:
+			for _ in self.replicas:
+				i, self.turn = self.turn, (self.turn + 1) % len(self.replicas)
+				if self.down.get(i, 0) <= now:
+					self.stats['replica'] += 1
+					return self.replicas[i]
+			self.stats['primary'] += 1
+			return self.primary
+
+	def failed(self, client):
+		"""A read from client failed to connect; skip it for a while."""
+		with self.lock:
+			if client in self.replicas:
+				self.down[self.replicas.index(client)] = time.time() + self.retry
+				self.stats['failures'] += 1
+
+	def behind(self):
+		"""A replica read was older than the client asked for and had to be
+		read again from the primary."""
+		with self.lock:
+			self.stats['behind'] += 1
+
+	def healthy(self):
+		"""How many replicas are not marked down."""
+		now = time.time()
+		with self.lock:
+			return sum(1 for i in range(len(self.replicas)) if self.down.get(i, 0) <= now)
+
+# -----------IGNOREBEYOND: test code ---------------
+import unittest
+
+
+class ReadPoolTestCase(unittest.TestCase):
+	"""Test replica selection"""
+
+	def setUp(self):
+		self.pool = ReadPool('primary', ['a', 'b', 'c'], retry=60)
+
+	def testRoundRobin(self):
+		self.assertEquals([ self.pool.next() for _ in range(6) ], ['a', 'b', 'c', 'a', 'b', 'c'])
+		self.assertEquals(ReadPool('primary').next(), 'primary')
+
+	def testFailover(self):
+		self.pool.failed('b')
+		self.pool.failed('primary')
+		self.assertEquals([ self.pool.next() for _ in range(4) ], ['a', 'c', 'a', 'c'])
+		self.assertEquals(self.pool.healthy(), 2)
+		self.pool.failed('a')
+		self.pool.failed('c')
+		self.assertEquals(self.pool.next(), 'primary')
+		self.assertEquals(self.pool.stats, { 'replica': 4, 'primary': 1, 'failures': 3, 'behind': 0 })
+
+	def testRetry(self):
+		self.pool.retry = 0
+		self.pool.failed('a')
+		self.assertEquals(self.pool.next(), 'a')
+
+
+if __name__ == "__main__":
+	unittest.main()
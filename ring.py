@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+	Consistent hash ring with virtual nodes
+
+	Every shard is placed on the ring at VNODES pseudo-random points; a key
+	belongs to the shard owning the first point at or after the key's own
+	hash. Adding or removing a shard only moves the keys between its points
+	and their predecessors, about 1/N of the total.
+'''
+
+import bisect
+import hashlib
+
+VNODES = 160
+
+def _hash(value):
+	return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+class HashRing(object):
+	def __init__(self, shards=(), vnodes=VNODES):
+		self.vnodes = vnodes
+		self.points = []  # sorted hashes
+		self.owners = []  # shard owning each point
+		for shard in shards:
+			self.add(shard)
+
+	def add(self, shard):
+		"""Place a shard on the ring."""
+		for i in xrange(self.vnodes):
+			point = _hash('%s#%d' % (shard, i))
+			ii = bisect.bisect_left(self.points, point)
+			self.points.insert(ii, point)
+			self.owners.insert(ii, shard)
+
+	def remove(self, shard):
+		"""Take a shard off the ring; its keys move to the next points."""
+		keep = [ii for ii, owner in enumerate(self.owners) if owner != shard]
+		self.points = [self.points[ii] for ii in keep]
+		self.owners = [self.owners[ii] for ii in keep]
+
+	def get(self, key):
+		"""Return the shard responsible for key."""
+		if not self.points:
+			raise KeyError("No shards on the ring")
+		ii = bisect.bisect_right(self.points, _hash(key))
+		return self.owners[ii % len(self.points)]
+
+# -----------IGNOREBEYOND: test code ---------------
+import unittest
+
+
+class HashRingTestCase(unittest.TestCase):
+	"""Test consistent hashing"""
+
+	def setUp(self):
+		self.keys = ['/rating/entity%d' % i for i in range(4000)]
+		self.ring = HashRing(['0', '1', '2', '3'])
+
+	def testSpread(self):
+		counts = {}
+		for key in self.keys:
+			shard = self.ring.get(key)
+			counts[shard] = counts.get(shard, 0) + 1
+		self.assertEquals(sorted(counts.keys()), ['0', '1', '2', '3'])
+		self.assertTrue(max(counts.values()) < 1.25 * len(self.keys) / 4)
+
+	def testMinimalMovement(self):
+		before = dict((key, self.ring.get(key)) for key in self.keys)
+		self.ring.add('4')
+		moved = [key for key in self.keys if self.ring.get(key) != before[key]]
+		self.assertTrue(all(self.ring.get(key) == '4' for key in moved))
+		self.assertTrue(len(moved) < 1.5 * len(self.keys) / 5)
+		self.ring.remove('4')
+		self.assertEquals(dict((key, self.ring.get(key)) for key in self.keys), before)
+
+	def testEmpty(self):
+		self.assertRaises(KeyError, HashRing().get, 'bob')
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -4,29 +4,355 @@
 import os
 import sys
 import time
+import atexit
+import signal
 import json
+import hashlib
+import itertools
 import StringIO
+import threading
+import collections
+
+config = { 'servers': [{ 'host': 'localhost', 'port': 6379 }] }
+
+if (len(sys.argv) > 1):
+	config = json.loads(sys.argv[1])
+
+# In gevent mode every socket becomes cooperative, so requests waiting on
+# Redis yield to each other instead of queueing behind one another. The
+# patching has to happen before anything else imports socket or threading.
+if config.get('mode') == 'gevent':
+	from gevent import monkey
+	monkey.patch_all()
 
 # Imports from installed libraries
 import redis
 import mimeparse
-from bottle import route, run, request, response, abort
+from bottle import route, run, request, response, abort, install
 
 # Imports from boilerplate
+import codec
+import metrics
+import antientropy
+import writebuffer
+from aggregates import Aggregates, FIELDS
+from cache import VersionedCache
+from replicas import ReadPool
+from ring import HashRing
 from vectorclock import VectorClock
 
-config = { 'servers': [{ 'host': 'localhost', 'port': 6379 }] }
+# Optional instrumentation, configured as { "metrics": true } and read from
+# GET /metrics. When it is off none of it is installed, so requests and Redis
+# calls run exactly as they would without it.
+registry = None
+if config.get('metrics'):
+	registry = metrics.Registry()
+	request_seconds = registry.histogram('rating_request_seconds', 'Time to answer a request, by route')
+	request_commands = registry.histogram('rating_request_redis_commands', 'Redis commands sent while answering a request, by route', buckets=(0, 1, 2, 3, 4, 6, 8, 16, 32, 64))
+	request_redis_seconds = registry.histogram('rating_request_redis_seconds', 'Time spent waiting on Redis while answering a request, by route')
+	redis_commands = registry.counter('rating_redis_commands_total', 'Redis commands sent, write buffer flushes included')
+	merges = registry.counter('rating_merges_total', 'Incoming ratings merged, by outcome')
+	superseded = registry.counter('rating_superseded_siblings_total', 'Siblings superseded by newer ratings')
+	siblings = registry.histogram('rating_siblings', 'Siblings an entity holds after a merge', buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 64, 128))
 
-if (len(sys.argv) > 1):
-	config = json.loads(sys.argv[1])
+# Redis commands sent and seconds spent in Redis by the request this thread
+# (or greenlet) is answering
+calls = threading.local()
+
+def called(commands, seconds):
+	redis_commands.inc(commands)
+	if hasattr(calls, 'commands'):
+		calls.commands += commands
+		calls.seconds += seconds
+
+# Clients that count and time their round trips, used when metrics are on
+class TimedPipeline(redis.client.Pipeline):
+	def execute(self, raise_on_error=True):
+		commands, start = len(self.command_stack), time.time()
+		try:
+			return super(TimedPipeline, self).execute(raise_on_error)
+		finally:
+			called(commands, time.time() - start)
+
+class TimedRedis(redis.StrictRedis):
+	def execute_command(self, *args, **options):
+		start = time.time()
+		try:
+			return super(TimedRedis, self).execute_command(*args, **options)
+		finally:
+			called(1, time.time() - start)
+
+	def pipeline(self, transaction=True, shard_hint=None):
+		return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+# Bottle plugin timing every route, and the Redis calls made while answering it
+class Instrument(object):
+	name = 'metrics'
+	api = 2
+
+	def apply(self, callback, route):
+		label = '%s %s' % (route.method, route.rule)
+		def timed(*args, **kwargs):
+			calls.commands, calls.seconds = 0, 0.0
+			start = time.time()
+			try:
+				return callback(*args, **kwargs)
+			finally:
+				request_seconds.observe(time.time() - start, route=label)
+				request_commands.observe(calls.commands, route=label)
+				request_redis_seconds.observe(calls.seconds, route=label)
+				del calls.commands, calls.seconds
+		return timed
+
+if registry: install(Instrument())
+
+# Connection pool for one Redis instance. In gevent mode the pool is bounded
+# and requests wait for a free connection rather than opening more.
+def pool(server):
+	if config.get('mode') == 'gevent':
+		return redis.BlockingConnectionPool(host=server['host'], port=server['port'], db=0, max_connections=config.get('pool', 64))
+	return redis.ConnectionPool(host=server['host'], port=server['port'], db=0)
+
+# Connect to every Redis instance, each with its own connection pool, and
+# spread the entities over them by consistent hashing. Each shard may list
+# read replicas, e.g. { "host": "localhost", "port": 6379, "replicas":
+# [{ "host": "localhost", "port": 6380 }] }; GETs are spread over them and
+# everything else goes to the primary.
+shards = { }
+readers = { }
+client = TimedRedis if registry else redis.StrictRedis
+for server in config['servers']:
+	name = str(server.get('id', '%s:%s' % (server['host'], server['port'])))
+	shards[name] = client(connection_pool=pool(server))
+	readers[name] = ReadPool(shards[name], [ client(connection_pool=pool(replica)) for replica in server.get('replicas', [ ]) ])
+ring = HashRing(shards.keys())
+
+def shard(key):
+	return shards[ring.get(key)]
+
+# The primary and read replicas of the shard holding key
+def reader(key):
+	return readers[ring.get(key)]
+
+# Server-side scripts; redis-py loads each once per shard and then calls it by hash
+def script(name):
+	return shards.values()[0].register_script(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name)).read())
+
+# Clock merge, and DELETE for a server with peers
+merge = script('merge.lua')
+forget = script('forget.lua')
+
+# Other regions taking writes for the same entities, configured as e.g.
+# { "peers": [{ "url": "http://eu.example.com:2500" }], "antientropy":
+# { "interval": 1.0 } }. Each shard then keeps the digests of the records it
+# holds, and every interval seconds the records that differ from a peer's
+# are pulled and merged like any write (see antientropy.py). The sibling
+# cap and clock pruning depend on the order writes arrive in, so regions
+# using them may settle on different siblings.
+peers = config.get('peers', [ ])
+DIGEST, BUCKET = antientropy.DIGEST, antientropy.BUCKET
+
+# The digest hash and bucket key list to keep up to date when key changes,
+# and its bucket; nothing without peers
+def digested(key):
+	if not peers: return [ ], [ ]
+	name = antientropy.bucket(key)
+	return [DIGEST, BUCKET+name], [name]
+
+# Optional cap on the siblings an entity may hold, configured as e.g.
+# { "siblings": { "limit": 16, "policy": "fold" } }. Beyond the limit the
+# 'fold' policy converges the oldest siblings into one with their mean
+# rating, while 'reject' turns away writes that would add a sibling.
+limits = config.get('siblings', { })
+if limits.get('policy', 'fold') not in ('fold', 'reject'):
+	raise ValueError("Unknown sibling policy %r" % limits['policy'])
+limit, policy = limits.get('limit', 0), limits.get('policy', 'fold')
+
+# Optional pruning of clock nodes that have stopped advancing, configured
+# as e.g. { "pruning": { "width": 50, "age": 2592000 } }: the least recently
+# advanced nodes go once the clocks hold more than width nodes, and any node
+# that has not advanced for age seconds goes too. Pruning can make an old
+# write look concurrent rather than stale, so keep an eye on the counters.
+pruning = config.get('pruning', { })
+width, age = pruning.get('width', 0), pruning.get('age', 0)
+
+# How often the cap was hit, and clocks were pruned or pruning put off
+capped = { "capped": 0, "folded": 0, "rejected": 0 }
+pruned = { "prunes": 0, "pruned": 0, "deferred": 0 }
+counts_lock = threading.Lock()
+
+# Pull the rating and vector clock out of a submitted record; None if malformed
+def parse(data):
+	# Basic sanity checks on the rating and clock
+	try:
+		setrating, setclock = codec.check(data.get('rating'), data.get('clocks', data.get('clock')))
+	except codec.CodecError:
+		return None
+	try:
+		setclock = VectorClock.fromDict(setclock)
+	except Exception:
+		return None
+	if not setclock.isValidClock(): return None
+	return setrating, setclock
+
+# Weave new ratings (choices, with clock dictionaries in clocks) into the
+# current rating list. The whole read-merge-write happens atomically inside
+# Redis in one round trip, which also bumps the record's version. A new
+# record's version starts at the time in microseconds, so it is above every
+# version of a record deleted before it: neither a cached version nor a
+# replica's copy from before a DELETE can be mistaken for the new record.
+# The reply is read by tally().
+def weave(client, key, choices, clocks):
+	now = time.time()
+	keys, args = digested(key)
+	args = [codec.pack(choices, clocks), int(now*1000000), limit, policy, width, age, repr(now)] + args
+	return merge(keys=[key]+keys, args=args, client=client)
+
+# What the merge script reports: the new mean rating; siblings folded and
+# incoming pairs rejected by the cap; nodes pruned and whether pruning was
+# put off; incoming pairs that were stale, superseded siblings (and how
+# many), or were added as concurrent siblings; the siblings left; and the
+# record's version after the write, or None if there is no record
+Merged = collections.namedtuple('Merged', 'rating folded rejected pruned deferred stale superseding superseded concurrent siblings version')
+
+# Count the cap being hit, clocks being pruned and merge outcomes in a reply
+# from weave; returns it as Merged
+def tally(reply):
+	merged = Merged(*reply)
+	if merged.folded or merged.rejected or merged.pruned or merged.deferred:
+		with counts_lock:
+			if merged.folded or merged.rejected:
+				capped["capped"] += 1
+				capped["folded"] += merged.folded
+				capped["rejected"] += merged.rejected
+			if merged.pruned:
+				pruned["prunes"] += 1
+				pruned["pruned"] += merged.pruned
+			pruned["deferred"] += merged.deferred
+	if registry:
+		for outcome in ('stale', 'superseding', 'concurrent', 'rejected'):
+			count = getattr(merged, outcome)
+			if count: merges.inc(count, outcome=outcome)
+		if merged.superseded: superseded.inc(merged.superseded)
+		siblings.observe(merged.siblings)
+	return merged
+
+# Read the whole record, ETag and running aggregates included, with a single
+# command
+def fetch(client, key):
+	return client.hmget(key, 'siblings', 'choices', 'clocks', 'version', 'etag', *FIELDS)
+
+# Decode a fetched record into (choices, clocks, aggregates)
+def load(reply):
+	siblings, choices, clocks, version, tag = reply[:5]
+	if siblings is not None:
+		choices, clocks = codec.unpack(siblings)
+	elif clocks is not None:
+		# Record in the old JSON layout, not yet upgraded by a PUT
+		choices, clocks = json.loads(choices), json.loads(clocks)
+	else:
+		choices, clocks = [ ], [ ]
+	# Records last written before aggregates were kept get them on the next PUT
+	return choices, clocks, Aggregates.fromFields(reply[5:]) or Aggregates.fromChoices(choices)
+
+# Strong ETag of a sibling set: the SHA-1 of its packed form, as merge.lua
+# stores it in the record's 'etag' field
+def etag(choices, clocks):
+	return quoted(hashlib.sha1(codec.pack(choices, clocks)).hexdigest())
+
+def quoted(digest):
+	return '"%s"' % digest
+
+# Whether an If-None-Match header names tag; weak tags compare by value
+def matches(header, tag):
+	if header.strip() == '*': return True
+	tags = [ t.strip() for t in header.split(',') ]
+	return tag in [ t[2:] if t.startswith('W/') else t for t in tags ]
+
+# Merge what the write buffer holds for an entity into its (choices, clocks,
+# aggregates), adjusting a copy of the aggregates by delta
+def overlay(choices, clocks, aggregates, pending):
+	aggregates = aggregates.copy()
+	for rating, clock in zip(*pending):
+		choices, clocks = writebuffer.merge(choices, clocks, rating, clock, aggregates) or (choices, clocks)
+	if limit and policy == 'fold':
+		choices, clocks = writebuffer.fold(choices, clocks, limit, aggregates)
+	return choices, clocks, aggregates
+
+# The response for an entity's (choices, clocks, aggregates)
+def respond(choices, clocks, aggregates):
+	if not choices:
+		return { "rating": None, "choices": None, "clocks": None, "summary": None }
+	return {
+		"rating": aggregates.mean,
+		"choices": json.dumps(choices),
+		"clocks": json.dumps(clocks),
+		"summary": aggregates.asDict()
+	}
+
+# Turn a fetched record, plus any (choices, clocks) still in the write
+# buffer, into the response for the entity
+def record(reply, pending=None):
+	stored = load(reply)
+	if pending:
+		stored = overlay(*(stored + (pending,)))
+	return respond(*stored)
+
+# Call fn(client, key, *args) for every (key, *args) in calls, pipelined so
+# each shard costs one round trip. Returns the replies in call order; with
+# errors, a call that failed, or whose shard could not be reached, has the
+# exception in place of its reply instead of raising it.
+def pipelined(fn, calls, errors=False):
+	pipes, order = { }, [ ]
+	for call in calls:
+		name = ring.get(call[0])
+		if name not in pipes: pipes[name] = shards[name].pipeline(transaction=False)
+		fn(pipes[name], *call)
+		order.append(name)
+	replies = { }
+	for name, pipe in pipes.iteritems():
+		try:
+			replies[name] = iter(pipe.execute(raise_on_error=not errors))
+		except redis.RedisError as e:
+			if not errors: raise
+			replies[name] = itertools.repeat(e)
+	return [ next(replies[name]) for name in order ]
 
-# Connect to a single Redis instance
-client = redis.StrictRedis(host=config['servers'][0]['host'], port=config['servers'][0]['port'], db=0)
+# Optional write-behind buffer: PUTs for the same entity are merged in memory
+# and reach Redis once per flush. Configured as e.g.
+# { "buffer": { "interval": 0.05, "size": 32, "limit": 10000 } }
+buffer = None
+if config.get('buffer') is not None:
+	# The cap applies when a flush reaches Redis; rejections there are
+	# counted but cannot be reported to the clients any more
+	# A sibling set whose merge failed is retried on its own
+	write = lambda batch: [ reply if isinstance(reply, Exception) else tally(reply) for reply in pipelined(weave, batch, errors=True) ]
+	buffer = writebuffer.WriteBuffer(write, **config['buffer']).start()
+	atexit.register(buffer.stop)
+	# Let the harness's terminate() run the final flush
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+# Optional read-through cache for GET /rating/<entity>, configured as e.g.
+# { "cache": { "size": 10000 } }. Entries are checked against the record's
+# version on every hit, so writes from any process invalidate them.
+cache = None
+if config.get('cache') is not None:
+	cache = VersionedCache(**config['cache'])
+
+# What the write buffer holds for key; read before Redis so that a flush
+# racing with the read is seen in at least one of the two
+def buffered(key):
+	return buffer.get(key) if buffer else None
 
 # A user updating their rating of something which can be accessed as:
 # curl -XPUT -H'Content-type: application/json' -d'{ "rating": 5, "clock": { "c1" : 5, "c2" : 3 } }' http://localhost:2500/rating/bob
-# Response is a JSON object specifying the new rating for the entity:
-# { rating: 5 }
+# Response is a JSON object specifying the new rating for the entity, and
+# the version of the record that holds it:
+# { rating: 5, version: 7300641 }
+# or HTTP 409 if the rating would add a sibling beyond the cap under the
+# 'reject' policy. The rating and version are null while the write buffer
+# holds the write, as the stored record is not read; GETs on this server see
+# buffered writes anyway.
 @route('/rating/<entity>', method='PUT')
 def put_rating(entity):
 
@@ -40,99 +366,156 @@ def put_rating(entity):
 	response.headers.append('Content-Type', type)
 	
 	# Read the data sent from the client
-	data = json.load(request.body)
-	setrating = data.get('rating')
-	setclock = VectorClock.fromDict(data.get('clocks'))
+	parsed = parse(json.load(request.body))
+	if not parsed: return abort(400)
 
-	# Basic sanity checks on the rating
-	if isinstance(setrating, int): setrating = float(setrating)
-	if not isinstance(setrating, float): return abort(400)
-
-	# Weave the new rating into the current rating list
 	key = '/rating/'+entity
-
-	# YOUR CODE GOES HERE
-	# REPLACE THE FOLLOWING LINE
-	# HINT: CONSIDER USING THE HASH DATA TYPE IN REDIS (HGET/HSET/...)
-	old_rating = client.hget(key, 'rating')
-
-	# if rating does not exist, add it. Otherwise..
-	# SET THE RATING, CHOICES, AND CLOCKS IN THE DATABASE FOR THIS KEY
-	# COMPUTE THE MEAN, finalrating
-	if not old_rating:
-		client.hset(key, 'rating', setrating)
-		client.hset(key, 'choices', [setrating])
-		client.hset(key, 'clocks', jsonify_vcl([setclock]))
-		finalrating = setrating
+	setrating, setclock = parsed
+	version = None
+	finalrating = None
+	if buffer:
+		# Reaches Redis on the next flush
+		buffer.put(key, setrating, setclock.asDict())
 	else:
-		finalrating = old_rating
-		choices = eval(client.hget(key, 'choices'))
-		vcl = eval(client.hget(key, 'clocks'))
-		new_vcl = []
-		new_choices = []
-		greaterThanAlreadyFound = False
-		needToUpdateDB = True
-		for i in range(0, len(vcl)):
-			old_clock = VectorClock.fromDict(vcl[i])
-			# if the received clock is older, nothing needs updating
-			if setclock <= old_clock:
-				needToUpdateDB = False
-				break
-			else:
-				# if the received clock is newer, make changes accordingly
-				if setclock > old_clock:
-					# If we have not found an older clock and replaced it with the 
-					# new one previously, put this new clock in. Otherwise, ignore.
-					if not greaterThanAlreadyFound:
-						greaterThanAlreadyFound = True
-						new_vcl.append(setclock)
-						new_choices.append(setrating)
-				# incomparable
-				else:
-					new_vcl.append(old_clock)
-					new_choices.append(choices[i])
-
-		# Update DB only if the received clock is not older than or the same as any of the
-		# existing clocks
-		if needToUpdateDB:
-			# if the received clock is not newer than any of the existing clocks, it's
-			# incomparable
-			if not greaterThanAlreadyFound:
-				new_vcl.append(setclock)
-				new_choices.append(setrating)
-
-			# calculate the new rating
-			ratingSum = 0.0
-			for choice in new_choices:
-				ratingSum+=choice
-			finalrating = ratingSum/len(new_choices)
-
-			# update DB
-			client.hset(key, 'rating', finalrating)
-			client.hset(key, 'choices', new_choices)
-			client.hset(key, 'clocks', jsonify_vcl(new_vcl))
-				
+		merged = tally(weave(shard(key), key, [setrating], [setclock.asDict()]))
+		# Turned away by the 'reject' policy
+		if merged.rejected: return abort(409, "Too many siblings")
+		finalrating, version = float(merged.rating), merged.version
 
 	# Return the new rating for the entity
 	return {
-		"rating": finalrating
+		"rating": finalrating,
+		"version": version
 	}
 
 
 # Add a route for getting the aggregate rating of something which can be accesed as:
 # curl -XGET http://localhost:2500/rating/bob
-# Response is a JSON object specifying the rating list and time list for the entity:
-# { rating: 5, choices: [5], clocks: [{c1: 3, c4: 10}] }
+# Response is a JSON object specifying the rating list and time list for the entity,
+# and a summary of the ratings:
+# { rating: 5, choices: [5], clocks: [{c1: 3, c4: 10}], summary: { count: 1, min: 5, max: 5, variance: 0 } }
+# The response carries an ETag of the sibling set; sent back in If-None-Match
+# while the siblings are unchanged, it gets an empty HTTP 304 instead.
+# Reads go to a replica when the shard has any. A client that must see its
+# own writes sends the version its last PUT returned in X-Min-Version, and
+# is answered from the primary whenever the replica is behind it.
 @route('/rating/<entity>', method='GET')
 def get_rating(entity):
-	# YOUR CODE GOES HERE
-	# REPLACE THE FOLLOWING LINES
 	key = '/rating/'+entity
-	return {
-		"rating": client.hget(key, 'rating'),
-        	"choices": client.hget(key, 'choices'),
-		"clocks": client.hget(key, 'clocks')
-	}
+	pending = buffered(key)
+	try:
+		minimum = int(request.headers.get('X-Min-Version', 0)) or None
+	except ValueError:
+		return abort(400)
+
+	replicas = reader(key)
+	client = replicas.next()
+	if client is not replicas.primary:
+		try:
+			answer = lookup(client, key, pending, minimum)
+		except (redis.ConnectionError, redis.TimeoutError):
+			# Counted as a failure, not as the replica lagging
+			replicas.failed(client)
+		else:
+			if answer is not None: return answer
+			replicas.behind()
+	return lookup(replicas.primary, key, pending, None)
+
+# Answer a GET of key from client, or return None if the record it holds is
+# older than version minimum
+def lookup(client, key, pending, minimum):
+	conditional = request.headers.get('If-None-Match')
+	def fresh(version):
+		return minimum is None or (version is not None and int(version) >= minimum)
+
+	# A poller whose copy is current is answered from the stored ETag alone,
+	# with one HMGET and without reading the siblings
+	if conditional and not pending:
+		current, version = client.hmget(key, 'etag', 'version')
+		if not fresh(version): return None
+		if current is not None and matches(conditional, quoted(current)):
+			return unchanged(quoted(current))
+
+	# With the cache on, a hit costs one HGET of the version; a miss reads
+	# the whole record, version included, with one HMGET
+	stored = cache.get(key, lambda: client.hget(key, 'version')) if cache else None
+	if stored is None:
+		reply = fetch(client, key)
+		loaded = load(reply)
+		# Records last written before ETags were stored get theirs derived
+		tag = quoted(reply[4]) if reply[4] is not None else etag(*loaded[:2]) if loaded[0] else None
+		stored = (loaded, respond(*loaded), tag, reply[3])
+		if cache and reply[3] is not None: cache.put(key, reply[3], stored)
+	loaded, finalrecord, tag, version = stored
+	if not fresh(version): return None
+	if pending:
+		loaded = overlay(*(loaded + (pending,)))
+		finalrecord, tag = respond(*loaded), etag(*loaded[:2])
+
+	if tag is None: return finalrecord
+	if conditional and matches(conditional, tag): return unchanged(tag)
+	response.set_header('ETag', tag)
+	return finalrecord
+
+def unchanged(tag):
+	response.status = 304
+	response.set_header('ETag', tag)
+	return ''
+
+# Bulk version of PUT /rating/<entity>, which can be accessed as:
+# curl -XPUT -H'Content-type: application/json' -d'[{ "entity": "bob", "rating": 5, "clock": { "c1": 5 } }]' http://localhost:2500/ratings
+# Records are merged in order, exactly as if PUT one at a time. Response holds
+# the new rating, or an error status, for each record; the rating is null
+# while the write buffer holds the record, as for a single PUT:
+# { results: [{ entity: "bob", rating: 5, version: 7300641 }] }
+@route('/ratings', method='PUT')
+def put_ratings():
+
+	type = mimeparse.best_match(['application/json'], request.headers.get('Accept'))
+	if not type: return abort(406)
+	if request.headers.get('Content-Type') != 'application/json': return abort(415)
+	response.headers.append('Content-Type', type)
+
+	data = json.load(request.body)
+	if not isinstance(data, list): return abort(400)
+
+	results, calls = [ ], [ ]
+	for item in data:
+		entity = item.get('entity') if isinstance(item, dict) else None
+		parsed = parse(item) if isinstance(entity, basestring) else None
+		if not parsed:
+			results.append({ "entity": entity, "error": 400 })
+		elif buffer:
+			buffer.put('/rating/'+entity, parsed[0], parsed[1].asDict())
+			results.append({ "entity": entity, "rating": None })
+		else:
+			results.append({ "entity": entity })
+			calls.append(('/rating/'+entity, [parsed[0]], [parsed[1].asDict()]))
+
+	pending = [ result for result in results if "error" not in result and "rating" not in result ]
+	for result, reply in zip(pending, pipelined(weave, calls)):
+		merged = tally(reply)
+		if merged.rejected:
+			result["error"] = 409
+		else:
+			result["rating"], result["version"] = float(merged.rating), merged.version
+	return { "results": results }
+
+# Bulk version of GET /rating/<entity>, which can be accessed as:
+# curl -XGET 'http://localhost:2500/ratings?entity=bob&entity=alice'
+# Response holds the record of each entity, in order:
+# { results: [{ entity: "bob", rating: 5, choices: [5], clocks: [{c1: 3}] }] }
+@route('/ratings', method='GET')
+def get_ratings():
+	entities = request.query.getall('entity')
+	pending = [ buffered('/rating/'+entity) for entity in entities ]
+	replies = pipelined(fetch, [ ('/rating/'+entity,) for entity in entities ])
+	results = [ ]
+	for entity, reply, held in zip(entities, replies, pending):
+		result = record(reply, held)
+		result["entity"] = entity
+		results.append(result)
+	return { "results": results }
 
 # Add a route for deleting all the rating information which can be accessed as:
 # curl -XDELETE http://localhost:2500/rating/bob
@@ -140,30 +523,132 @@ def get_rating(entity):
 # { rating: null }
 @route('/rating/<entity>', method='DELETE')
 def delete_rating(entity):
-	count = client.delete('/rating/'+entity)
-	if count == 0: return abort(404)
+	key = '/rating/'+entity
+	dropped = buffer.discard(key) if buffer else False
+	if cache: cache.discard(key)
+	if peers:
+		keys, args = digested(key)
+		count = forget(keys=[key]+keys, args=args, client=shard(key))
+	else:
+		count = shard(key).delete(key)
+	if count == 0 and not dropped: return abort(404)
 	return { "rating": None }
 
-# Turn a list of vector clocks into a JSON formatted string to be stored in redis
-def jsonify_vcl(vcl):
-	i = 0
-	json_str = '['
-	#json_str = ''
-	for vc in vcl:
-		json_str = json_str+'{'
-		i += 1
-		j = 0
-		for key in vc.clock.keys():
-			json_str = json_str+'"'+key+'"'+': '+str(vc.clock[key])
-			j+=1
-			if j < len(vc.clock.keys()):
-				json_str = json_str+', '
-		json_str = json_str+'}'
-		if i < len(vcl):
-			json_str = json_str + ', '
-	json_str = json_str+']'
-	return json_str
+# This region as anti-entropy sees it: the digests and records held by
+# every shard
+class LocalRegion(object):
+	def digests(self, prefixes):
+		leaves = collections.Counter()
+		for client in shards.itervalues():
+			leaves.update(dict((name, int(total)) for name, total in client.hgetall(DIGEST).iteritems()))
+		return antientropy.children(leaves, prefixes)
+
+	def keys(self, buckets):
+		tags = { }
+		for client in shards.itervalues():
+			pipe = client.pipeline(transaction=False)
+			for name in buckets: pipe.hgetall(BUCKET+name)
+			for reply in pipe.execute(): tags.update(reply)
+		return tags
+
+	def records(self, keys):
+		loaded = [ load(reply)[:2] for reply in pipelined(fetch, [ (key,) for key in keys ]) ]
+		return dict((key, record) for key, record in zip(keys, loaded) if record[0])
+
+	def merge(self, key, choices, clocks):
+		return tally(weave(shard(key), key, choices, clocks))
+
+entropy = None
+if peers:
+	entropy = antientropy.AntiEntropy(LocalRegion(), [ antientropy.Peer(peer['url']) for peer in peers ], **config.get('antientropy', { })).start()
+	atexit.register(entropy.stop)
+
+# What a peer reads to compare this region with its own, which can be
+# accessed as:
+# curl -XGET 'http://localhost:2500/antientropy/digest?prefix=a&prefix=b'
+# { a0: 51392811, a1: 9283310, ..., bf: 7730219 }
+# curl -XPOST -H'Content-type: application/json' -d'{ "buckets": ["a1f"] }' http://localhost:2500/antientropy/keys
+# { /rating/bob: "9f86d081884c7d65...", ... }
+# curl -XPOST -H'Content-type: application/json' -d'{ "keys": ["/rating/bob"] }' http://localhost:2500/antientropy/records
+# { /rating/bob: { choices: [5], clocks: [{ c1: 3 }] } }
+# Only served when the server has peers.
+@route('/antientropy/digest', method='GET')
+def get_digest():
+	if not entropy: return abort(404)
+	return entropy.local.digests(request.query.getall('prefix'))
+
+# The strings listed under name in a JSON request body, or None
+def listed(name):
+	data = json.load(request.body)
+	items = data.get(name) if isinstance(data, dict) else None
+	if not isinstance(items, list) or not all(isinstance(item, basestring) for item in items): return None
+	return items
+
+@route('/antientropy/keys', method='POST')
+def post_keys():
+	if not entropy: return abort(404)
+	buckets = listed('buckets')
+	if buckets is None: return abort(400)
+	return entropy.local.keys(buckets)
+
+@route('/antientropy/records', method='POST')
+def post_records():
+	if not entropy: return abort(404)
+	keys = listed('keys')
+	if keys is None or not all(key.startswith('/rating/') for key in keys): return abort(400)
+	return dict((key, { "choices": choices, "clocks": clocks }) for key, (choices, clocks) in entropy.local.records(keys).iteritems())
+
+# Sync with every peer now rather than at the next interval, which can be
+# accessed as:
+# curl -XPOST http://localhost:2500/antientropy
+# Response holds the anti-entropy counters after the round:
+# { rounds: 3, nodes: 5, buckets: 1, pulled: 1, errors: 0 }
+@route('/antientropy', method='POST')
+def post_antientropy():
+	if not entropy: return abort(404)
+	return entropy.round()
+
+# Counters for the write buffer, read cache, sibling cap, clock pruning,
+# replica reads and anti-entropy, which can be accessed as:
+# curl -XGET http://localhost:2500/stats
+# { buffer: { writes: 10, ... }, cache: { hits: 5, ... }, siblings: { capped: 1, ... }, clocks: { prunes: 2, ... }, replicas: { replica: 9, ... }, antientropy: { rounds: 3, ... } }
+@route('/stats', method='GET')
+def get_stats():
+	return {
+		"buffer": buffer.stats if buffer else None,
+		"cache": cache.stats if cache else None,
+		"siblings": capped,
+		"clocks": pruned,
+		"replicas": replicated(),
+		"antientropy": dict(entropy.stats) if entropy else None
+	}
+
+# Replica read counters summed over the shards, with the replicas not marked
+# down; None if no shard has replicas
+def replicated():
+	pools = [ pool for pool in readers.itervalues() if pool.replicas ]
+	if not pools: return None
+	totals = dict((name, sum(pool.stats[name] for pool in pools)) for name in pools[0].stats)
+	totals['healthy'] = sum(pool.healthy() for pool in pools)
+	return totals
+
+# Request, Redis and merge metrics, plus the counters from /stats, in the
+# Prometheus text format, which can be accessed as:
+# curl -XGET http://localhost:2500/metrics
+# Only served when metrics are on.
+@route('/metrics', method='GET')
+def get_metrics():
+	if not registry: return abort(404)
+	response.content_type = 'text/plain; version=0.0.4'
+	lines = [ ]
+	for group, counts in sorted(get_stats().iteritems()):
+		for name, value in sorted((counts or { }).iteritems()):
+			lines.append('rating_%s_%s %s' % (group, name, value))
+	return registry.render() + ''.join(line + '\n' for line in lines)
 
 # Fire the engines
 if __name__ == '__main__':
-	run(host='0.0.0.0', port=os.getenv('PORT', 2500), quiet=True)
+	if config.get('mode') == 'gevent':
+		run(host='0.0.0.0', port=int(os.getenv('PORT', 2500)), quiet=True, server='gevent')
+	else:
+		run(host='0.0.0.0', port=os.getenv('PORT', 2500), quiet=True)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+'''
+	Streaming export and import of every rating
+
+	Export walks the /rating/* keys of every shard with SCAN, so Redis is
+	never blocked for long, and reads them back in pipelined batches. It
+	writes each record as a line of NDJSON, { "key": ..., "choices": ...,
+	"clocks": ... }, or in the binary format: MAGIC, then for each record
+	the key and its sibling set packed by codec.py, each as a varint length
+	and the bytes. SCAN may return a key twice; importing a record twice
+	changes nothing.
+
+	Import reads either format and merges each record into what is stored
+	with merge.lua, batch records at a time pipelined per shard, so the
+	clock rules apply and nothing newer is overwritten. Keys are placed by
+	the ring of the configuration given, so a snapshot can move the ratings
+	to a different set of shards. A record holding a rating or clock that a
+	PUT would refuse is counted as invalid and left out.
+
+	Both hold one batch at a time, whatever the size of the data set, and
+	report their throughput on stderr:
+
+		python snapshot.py export '{ "servers": [...] }' > ratings.ndjson
+		python snapshot.py import '{ "servers": [...] }' < ratings.ndjson
+
+	The configuration is the server's; its sibling cap, clock pruning and
+	peers apply to imported records as they would to PUTs.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+
+import redis
+
+import codec
+import antientropy
+from ring import HashRing
+
+# Start of a binary snapshot
+MAGIC = 'R\x01'
+
+PATTERN = '/rating/*'
+
+class SnapshotError(ValueError):
+	pass
+
+def _varint(out, n):
+	while n >= 0x80:
+		out.append(chr((n & 0x7f) | 0x80))
+		n >>= 7
+	out.append(chr(n))
+
+def _readvarint(stream, b=None):
+	n = shift = 0
+	while True:
+		if b is None: b = stream.read(1)
+		if not b:
+			raise SnapshotError("Truncated snapshot")
+		n |= (ord(b) & 0x7f) << shift
+		if ord(b) < 0x80:
+			return n
+		shift, b = shift + 7, None
+
+def _readtext(stream, b=None):
+	length = _readvarint(stream, b)
+	text = stream.read(length)
+	if len(text) < length:
+		raise SnapshotError("Truncated snapshot")
+	return text
+
+def decode(reply):
+	"""(choices, clocks) of an HMGET of 'siblings', 'choices' and 'clocks'."""
+	siblings, choices, clocks = reply
+	if siblings is not None:
+		return codec.unpack(siblings)
+	if clocks is not None:
+		# Record in the old JSON layout
+		return json.loads(choices), json.loads(clocks)
+	return [ ], [ ]
+
+def scan(client, batch):
+	"""Every (key, choices, clocks) held by client, read batch at a time."""
+	keys = [ ]
+	for key in client.scan_iter(match=PATTERN, count=batch):
+		keys.append(key)
+		if len(keys) >= batch:
+			for record in fetch(client, keys): yield record
+			keys = [ ]
+	for record in fetch(client, keys): yield record
+
+def fetch(client, keys):
+	pipe = client.pipeline(transaction=False)
+	for key in keys:
+		pipe.hmget(key, 'siblings', 'choices', 'clocks')
+	for key, reply in zip(keys, pipe.execute()):
+		choices, clocks = decode(reply)
+		# Deleted since SCAN returned it
+		if choices: yield key, choices, clocks
+
+class NDJSONWriter(object):
+	def __init__(self, out):
+		self.out = out
+
+	def write(self, key, choices, clocks):
+		self.out.write(json.dumps({ 'key': key, 'choices': choices, 'clocks': clocks }) + '\n')
+
+class BinaryWriter(object):
+	def __init__(self, out):
+		self.out = out
+		self.out.write(MAGIC)
+
+	def write(self, key, choices, clocks):
+		packed = codec.pack(choices, clocks)
+		out = [ ]
+		_varint(out, len(key))
+		out.append(key)
+		_varint(out, len(packed))
+		out.append(packed)
+		self.out.write(''.join(out))
+
+WRITERS = { 'ndjson': NDJSONWriter, 'binary': BinaryWriter }
+
+def read(stream):
+	"""Every (key, choices, clocks) in a snapshot of either format."""
+	start = stream.read(len(MAGIC))
+	if start == MAGIC:
+		# Records follow each other to the end of the stream
+		for b in iter(lambda: stream.read(1), ''):
+			key = _readtext(stream, b)
+			choices, clocks = codec.unpack(_readtext(stream))
+			yield key, choices, clocks
+		return
+	lines = iter(stream.readline, '')
+	if start: lines = itertools.chain([ start + stream.readline() ], lines)
+	for number, line in enumerate(lines, 1):
+		if not line.strip(): continue
+		try:
+			record = json.loads(line)
+			key, choices, clocks = record['key'], record['choices'], record['clocks']
+		except (ValueError, KeyError, TypeError):
+			raise SnapshotError("Line %d is not a record" % number)
+		yield key, choices, clocks
+
+class Progress(object):
+	"""Reports how many records went by, and how fast, every every seconds
+	and when done."""
+
+	def __init__(self, verb, out=sys.stderr, every=5.0):
+		self.verb = verb
+		self.out = out
+		self.every = every
+		self.count = 0
+		self.start = self.last = time.time()
+
+	def tick(self, n=1):
+		self.count += n
+		now = time.time()
+		if now - self.last >= self.every:
+			self.last = now
+			self.report(now)
+
+	def report(self, now=None, extra=''):
+		elapsed = max((now or time.time()) - self.start, 1e-9)
+		self.out.write('%s %d records in %.1fs (%.0f/s)%s\n' % (self.verb, self.count, elapsed, self.count/elapsed, extra))
+		self.out.flush()
+
+def check(key, choices, clocks):
+	"""Return the record's (choices, clocks), each pair checked as a PUT's
+	would be, or raise CodecError: a snapshot may have been edited, and JSON
+	allows NaN and the infinities."""
+	if not isinstance(key, basestring) or not key.startswith('/rating/'):
+		raise codec.CodecError("Not a rating key: %r" % key)
+	if not isinstance(choices, list) or not isinstance(clocks, list) or len(choices) != len(clocks):
+		raise codec.CodecError("Malformed record %r" % key)
+	pairs = [ codec.check(rating, clock) for rating, clock in zip(choices, clocks) ]
+	return [ rating for rating, _ in pairs ], [ clock for _, clock in pairs ]
+
+class Importer(object):
+	"""Merges records into the shards of a server configuration, batch
+	records at a time."""
+
+	def __init__(self, config, batch=1000):
+		self.batch = batch
+		self.shards = { }
+		for server in config['servers']:
+			name = str(server.get('id', '%s:%s' % (server['host'], server['port'])))
+			self.shards[name] = redis.StrictRedis(host=server['host'], port=server['port'], db=0)
+		self.ring = HashRing(self.shards.keys())
+		self.merge = self.shards.values()[0].register_script(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'merge.lua')).read())
+		# As server.py passes them
+		limits, pruning = config.get('siblings', { }), config.get('pruning', { })
+		self.options = [ limits.get('limit', 0), limits.get('policy', 'fold'), pruning.get('width', 0), pruning.get('age', 0) ]
+		self.peers = bool(config.get('peers'))
+		self.stats = { 'records': 0, 'pairs': 0, 'stale': 0, 'rejected': 0, 'invalid': 0 }
+
+	def run(self, records, progress=None):
+		pending = [ ]
+		for record in records:
+			pending.append(record)
+			if len(pending) >= self.batch:
+				self.flush(pending)
+				if progress: progress.tick(len(pending))
+				pending = [ ]
+		self.flush(pending)
+		if progress: progress.tick(len(pending))
+		return self.stats
+
+	def flush(self, records):
+		pipes, order = { }, [ ]
+		now = time.time()
+		for key, choices, clocks in records:
+			try:
+				choices, clocks = check(key, choices, clocks)
+				args = [ codec.pack(choices, clocks), int(now*1000000) ] + self.options + [ repr(now) ]
+			except (codec.CodecError, TypeError, ValueError):
+				self.stats['invalid'] += 1
+				continue
+			keys = [ key ]
+			if self.peers:
+				name = antientropy.bucket(key)
+				keys, args = keys + [ antientropy.DIGEST, antientropy.BUCKET+name ], args + [ name ]
+			shard = self.ring.get(key)
+			if shard not in pipes: pipes[shard] = self.shards[shard].pipeline(transaction=False)
+			self.merge(keys=keys, args=args, client=pipes[shard])
+			order.append((shard, len(choices)))
+		replies = dict((shard, iter(pipe.execute())) for shard, pipe in pipes.iteritems())
+		for shard, pairs in order:
+			reply = next(replies[shard])
+			self.stats['records'] += 1
+			self.stats['pairs'] += pairs
+			self.stats['stale'] += reply[5]
+			self.stats['rejected'] += reply[2]
+
+def export(clients, writer, batch=1000, progress=None):
+	"""Write every record held by clients; returns how many."""
+	count = 0
+	for client in clients:
+		for record in scan(client, batch):
+			writer.write(*record)
+			count += 1
+			if progress: progress.tick()
+	return count
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Export every rating to a snapshot, or import one, merging it into what is stored.')
+	parser.add_argument('command', choices=['export', 'import'])
+	parser.add_argument('config', nargs='?', default='{ "servers": [{ "host": "localhost", "port": 6379 }] }', help="the server's configuration, as JSON")
+	parser.add_argument('--format', choices=sorted(WRITERS), default='ndjson', help='what to export as (default ndjson); import reads either')
+	parser.add_argument('--batch', type=int, default=1000, help='records read or merged with one round trip (default 1000)')
+	parser.add_argument('--every', type=float, default=5.0, help='seconds between progress reports (default 5)')
+	args = parser.parse_args(argv)
+	config = json.loads(args.config)
+
+	if args.command == 'export':
+		progress = Progress('exported', every=args.every)
+		clients = [ redis.StrictRedis(host=server['host'], port=server['port'], db=0) for server in config['servers'] ]
+		export(clients, WRITERS[args.format](sys.stdout), args.batch, progress)
+		sys.stdout.flush()
+		progress.report()
+	else:
+		progress = Progress('imported', every=args.every)
+		stats = Importer(config, args.batch).run(read(sys.stdin), progress)
+		progress.report(extra=': %(pairs)d pairs, %(stale)d stale, %(rejected)d rejected, %(invalid)d invalid' % stats)
+
+# Run with a command, this is the tool; without one, the tests below run
+if __name__ == '__main__' and sys.argv[1:2] in (['export'], ['import']):
+	main(sys.argv[1:])
+	sys.exit(0)
+
+# -----------IGNOREBEYOND: test code ---------------
+import unittest
+import StringIO
+
+
+class SnapshotTestCase(unittest.TestCase):
+	"""Test snapshot formats"""
+
+	def setUp(self):
+		self.records = [
+			('/rating/bob', [5.0, 2.0], [{ 'c0': 5 }, { 'c1': 3 }]),
+			('/rating/tea-x', [3.25], [{ 'c0': 7, 'c1': 10 }])
+		]
+
+	def roundTrip(self, format):
+		out = StringIO.StringIO()
+		writer = WRITERS[format](out)
+		for record in self.records:
+			writer.write(*record)
+		return list(read((StringIO.StringIO(out.getvalue())))), out.getvalue()
+
+	def testNDJSON(self):
+		records, data = self.roundTrip('ndjson')
+		self.assertEquals(records, self.records)
+		self.assertEquals(len(data.splitlines()), 2)
+
+	def testBinary(self):
+		records, data = self.roundTrip('binary')
+		self.assertEquals(records, self.records)
+		self.assertTrue(data.startswith(MAGIC))
+		self.assertTrue(len(data) < len(self.roundTrip('ndjson')[1])/2)
+
+	def testEmpty(self):
+		self.assertEquals(list(read((StringIO.StringIO('')))), [])
+		self.assertEquals(list(read((StringIO.StringIO(MAGIC)))), [])
+
+	def testErrors(self):
+		data = self.roundTrip('binary')[1]
+		self.assertRaises(SnapshotError, list, read((StringIO.StringIO(data[:-3]))))
+		self.assertRaises(SnapshotError, list, read((StringIO.StringIO('{"key": "/rating/bob"}\n'))))
+
+	def testCheck(self):
+		self.assertEquals(check('/rating/bob', [5, 2.0], [{ 'c0': 5 }, { 'c1': 3 }]), ([5.0, 2.0], [{ 'c0': 5 }, { 'c1': 3 }]))
+		for record in [ ('/other/bob', [5.0], [{ 'c0': 1 }]), ('/rating/bob', [5.0], [ ]), ('/rating/bob', '5', '{}'),
+		                ('/rating/bob', [float('nan')], [{ 'c0': 1 }]), ('/rating/bob', [1.7e308, 1.7e308], [{ 'c0': 1 }, { 'c1': 1 }]),
+		                ('/rating/bob', [5.0], [{ 'c0': 2**53 + 1 }]) ]:
+			self.assertRaises(codec.CodecError, check, *record)
+		# As read from a snapshot
+		records = list(read(StringIO.StringIO('{"key": "/rating/bob", "choices": [NaN], "clocks": [{"c0": 1}]}\n'
+		                                       '{"key": "/rating/tea", "choices": [Infinity], "clocks": [{"c0": 1}]}\n')))
+		for record in records:
+			self.assertRaises(codec.CodecError, check, *record)
+
+	def testProgress(self):
+		out = StringIO.StringIO()
+		progress = Progress('exported', out, every=3600)
+		progress.tick(5)
+		self.assertEquals(out.getvalue(), '')
+		progress.report()
+		self.assertTrue(out.getvalue().startswith('exported 5 records in '))
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding=utf8
+
+# Microbenchmarks for the vector clock operations the server relies on,
+# checked against a stored baseline
+
+import sys, os, json, random, timeit, argparse
+from termcolor import colored
+
+sys.path.append(sys.path[0]+'/..')
+
+from vectorclock import VectorClock, CompactVectorClock, ClockSet, ClockMatrix, numpy
+import writebuffer
+
+parser = argparse.ArgumentParser(description='Time vector clock operations and compare them against a baseline.')
+
+parser.add_argument('--baseline', dest='baseline', action='store', nargs='?', default=os.path.join(sys.path[0], 'bench.json'), help='baseline file (default test/bench.json)')
+parser.add_argument('--save', action='store_true', help='store this run as the new baseline instead of checking it')
+parser.add_argument('--threshold', type=float, default=2.0, help='slowdown relative to the baseline that counts as a regression (default 2.0)')
+parser.add_argument('--only', action='store', nargs='?', default=None, help='only run operations whose name starts with this')
+args = parser.parse_args()
+
+# Grid of sibling counts and clock widths every operation is timed over
+SIBLINGS = [ 1, 4, 16, 64 ]
+WIDTHS = [ 1, 8, 64 ]
+
+# Shortest time a measurement may take, in seconds, and how many are taken
+MEASURE = 0.05
+REPEAT = 3
+
+# How many times an apparent regression is timed again
+RETRIES = 3
+
+def measure(f):
+	"""Best time of one call to f over REPEAT measurements, in seconds."""
+	timer = timeit.Timer(f)
+	number = 1
+	while timer.timeit(number) < MEASURE:
+		number *= 4
+	return min(timer.repeat(REPEAT, number))/number
+
+def siblings(count, width, seed):
+	"""count clocks of width nodes each, drawn from a pool twice as wide, so
+	most pairs are concurrent; returned as dictionaries with their ratings."""
+	rng = random.Random(seed)
+	pool = [ 'c%d' % i for i in range(2*width) ]
+	clocks = [ dict((node, rng.randint(1, 100)) for node in rng.sample(pool, width)) for _ in range(count) ]
+	return [ float(rng.randint(1, 5)) for _ in range(count) ], clocks
+
+def operations(count, width):
+	"""The operations to time for a sibling set of this shape, by name."""
+	choices, clocks = siblings(count, width, '%d/%d' % (count, width))
+	vcs = [ VectorClock.fromDict(clock) for clock in clocks ]
+	compacts = [ CompactVectorClock.fromDict(clock) for clock in clocks ]
+	pairs = zip(choices, vcs)
+	rating, clock = 3.0, siblings(1, width, 'new/%d' % width)[1][0]
+	antichain = ClockSet()
+	for choice, vc in pairs:
+		antichain.insert(choice, vc)
+	incoming = VectorClock.fromDict(clock)
+	timed = {
+		'fromDict': lambda: [ VectorClock.fromDict(dct) for dct in clocks ],
+		'compare': lambda: [ vc.compare(other) for vc in vcs for other in vcs ],
+		'compare.compact': lambda: [ vc.compare(other) for vc in compacts for other in compacts ],
+		'lessThan': lambda: [ vc < other for vc in vcs for other in vcs ],
+		'coalesce': lambda: VectorClock.coalesce(vcs),
+		'coalesce2': lambda: VectorClock.coalesce2(pairs),
+		'converge': lambda: VectorClock.converge(vcs),
+		'merge': lambda: writebuffer.merge(choices, clocks, rating, clock),
+		'clockset.insert': lambda: antichain.copy().insert(rating, incoming),
+		'dominance': lambda: [ vc.compare(incoming) for vc in vcs ]
+	}
+	# The batch forms of the same operations, where numpy is installed
+	if numpy is not None:
+		matrix = ClockMatrix.fromClocks(vcs, choices)
+		timed.update({
+			'matrix.dominance': lambda: matrix.dominance(incoming),
+			'matrix.merge': lambda: matrix.merge(incoming, rating),
+			'matrix.coalesce': lambda: matrix.coalesced(),
+			'matrix.converge': lambda: matrix.converge()
+		})
+	return timed
+
+def run():
+	results, timed = { }, { }
+	for count in SIBLINGS:
+		for width in WIDTHS:
+			for name, f in sorted(operations(count, width).iteritems()):
+				if args.only and not name.startswith(args.only): continue
+				key = '%s/s=%d/w=%d' % (name, count, width)
+				results[key], timed[key] = measure(f), f
+				sys.stdout.write('{0:<32} {1:>12.2f}µs\n'.format(key, results[key]*1e6))
+				sys.stdout.flush()
+	return results, timed
+
+results, timed = run()
+
+if args.save:
+	with open(args.baseline, 'w') as f:
+		json.dump({ 'python': sys.version.split()[0], 'results': results }, f, indent=1, sort_keys=True)
+		f.write('\n')
+	print('Saved baseline to %s' % args.baseline)
+	sys.exit(0)
+
+with open(args.baseline) as f:
+	baseline = json.load(f)
+
+# Timings only compare on the same machine, so save a baseline there first
+regressions = [ ]
+for key in sorted(results):
+	if key not in baseline['results']: continue
+	ratio = results[key]/(baseline['results'][key])
+	# Time anything that looks slower again before believing it
+	for attempt in range(RETRIES):
+		if ratio <= args.threshold: break
+		results[key] = min(results[key], measure(timed[key]))
+		ratio = results[key]/(baseline['results'][key])
+	if ratio > args.threshold:
+		regressions.append(key)
+		print(colored('✖ {0:<30} {1:>6.2f}x baseline'.format(key, ratio), 'red'))
+
+if regressions:
+	print(colored('%d of %d operations regressed past %.2fx' % (len(regressions), len(results), args.threshold), 'red'))
+	sys.exit(1)
+print(colored('No operation regressed past %.2fx' % args.threshold, 'green'))
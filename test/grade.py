@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # coding=utf8
 
-import random, sys, os, json, argparse, math, itertools
+import random, sys, os, json, argparse, math
 from termcolor import colored
 
 parser = argparse.ArgumentParser(description='Process.')
@@ -34,9 +34,7 @@ def check(expected, got):
 		elif isinstance(expected, int): return expected == int(got)
 		elif isinstance(expected, str): return expected == str(got)
 		elif isinstance(expected, dict): return expected == got
-		elif isinstance(expected, list): 
-			if len(got) > 10: return False
-			return len(expected) == len(got) and any(all(check(*args) for args in zip(expected,perms)) for perms in itertools.permutations(got))
+		elif isinstance(expected, list): return len(expected) == len(got) and match(expected, list(got))
 		elif expected == None: return got == None
 	# If coercions are not possible, then we're hosed
 	except TypeError:
@@ -46,6 +44,44 @@ def check(expected, got):
 
 	raise TypeError()
 
+# Sort key that puts equal items of any nesting next to each other
+def canonical(item):
+	if isinstance(item, (int, long, float)) and not isinstance(item, bool): return (0, float(item))
+	elif isinstance(item, dict): return (1, sorted((canonical(k), canonical(v)) for k, v in item.iteritems()))
+	elif isinstance(item, (list, tuple)): return (2, sorted(canonical(i) for i in item))
+	return (3, item)
+
+# Match two lists as multisets under check(). Sorting both sides lines equal
+# items up, which settles almost every list; when tolerances make that fail,
+# fall back to a bipartite matching by augmenting paths.
+def match(expected, got):
+	if all(check(*args) for args in zip(sorted(expected, key=canonical), sorted(got, key=canonical))):
+		return True
+	edges = [ [ j for j, g in enumerate(got) if check(e, g) ] for e in expected ]
+	owner = [ None ]*len(got)
+	def augment(i, seen):
+		for j in edges[i]:
+			if j in seen: continue
+			seen.add(j)
+			if owner[j] is None or augment(owner[j], seen):
+				owner[j] = i
+				return True
+		return False
+	return all(augment(i, set()) for i in range(len(expected)))
+
+# Check that a count stays within its budget
+def budget(expected, got):
+	try:
+		return float(got) <= expected
+	except (TypeError, ValueError):
+		return False
+
+# Result types that are checked against a budget rather than for a match
+matchers = {
+	'EXPECT_COMMANDS': budget,
+	'EXPECT_SHARD_LOAD': budget
+}
+
 # Check a list of items with exponential falloff
 def checklist(entries, factor=None, weight=1.0):
 	n = len(entries)
@@ -54,7 +90,7 @@ def checklist(entries, factor=None, weight=1.0):
 	# Calculate the default falloff
 	if factor == None: factor = 1.0-1.0/n
 	
-	errors = [ entry for entry in entries if not check(entry['expected'], entry['got']) ]
+	errors = [ entry for entry in entries if not matchers.get(entry['type'], check)(entry['expected'], entry['got']) ]
 	correct = n - len(errors)
 	# Do the magic
 	grade = (float(correct)/float(n))*(factor**(n - correct))
@@ -97,6 +133,70 @@ def coalescableData(results):
 def longerSequence(results):
 	return checklist(results)	
 
+@grade(weight=0.1)
+def bulkRatings(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def ratingPrecision(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def invalidRatings(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def largeCounters(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def commandBudget(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def shardSpread(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def hotEntity(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def readCache(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def ratingSummary(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def siblingCap(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def clockPruning(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def instrumentation(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def conditionalGet(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def replicaReads(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def antiEntropy(results):
+	return checklist(results)
+
+@grade(weight=0.05)
+def snapshots(results):
+	return checklist(results)
+
 results = { }
 for line in args.input:
 	obj = json.loads(line)
@@ -5,6 +5,7 @@
 
 # Core libraries
 import math
+import bisect
 import random
 import string
 import StringIO
@@ -15,10 +16,14 @@ import functools
 import os
 import time
 import json
+import Queue
+import atexit
 import shutil
 import argparse
 import urlparse
+import threading
 import subprocess
+from multiprocessing.pool import ThreadPool
 
 # Extend path to our containing directory, so we can import vectorclock
 import sys
@@ -31,15 +36,48 @@ from termcolor import colored
 
 # File distributed with assignment boilerplate
 from vectorclock import VectorClock
+import snapshot
 
 
+# Sends results to a URL from a background thread, as batches of NDJSON
+# lines over one keep-alive connection, so uploads stay out of the timings
 class HTTPOutput():
-	def __init__(self, url):
+	def __init__(self, url, batch=200, interval=0.5, size=10000):
 		self.url = url
+		self.batch = batch        # most lines per POST
+		self.interval = interval  # longest a line waits to be sent, in seconds
+		self.lines = Queue.Queue(size)
+		self.session = requests.Session()
+		self.thread = threading.Thread(target=self.send)
+		self.thread.daemon = True
+		self.thread.start()
 	def write(self, data):
-		requests.post(self.url, data=data, headers={ 'Content-type': 'application/json' })
+		# Only blocks once size lines are waiting to go out
+		self.lines.put(data)
 	def flush(self):
 		pass
+	def close(self):
+		# Send everything written so far, then stop
+		self.lines.put(None)
+		self.thread.join()
+	def send(self):
+		batch, deadline, line = [ ], None, ''
+		while line is not None:
+			try:
+				line = self.lines.get(timeout=None if deadline is None else max(deadline - time.time(), 0))
+			except Queue.Empty:
+				line = ''
+			if line:
+				if not batch: deadline = time.time() + self.interval
+				batch.append(line)
+			if batch and (not line or len(batch) >= self.batch):
+				self.post(''.join(batch))
+				batch, deadline = [ ], None
+	def post(self, data):
+		try:
+			self.session.post(self.url, data=data, headers={ 'Content-type': 'application/x-ndjson' })
+		except requests.RequestException as e:
+			sys.stderr.write('Could not send results to %s: %s\n' % (self.url, e))
 
 parser = argparse.ArgumentParser(description='Process.')
 
@@ -62,6 +100,56 @@ parser.add_argument('--leavedb',
                     action='store_true',
                     help='leave the database after termination')
 
+parser.add_argument('--shards',
+                    dest='shards',
+                    action='store',
+                    type=int,
+                    default=1,
+                    help='number of redis-servers to shard over')
+
+parser.add_argument('--replicas',
+                    type=int,
+                    default=0,
+                    help='read replicas to start for every shard (default 0)')
+
+parser.add_argument('--regions',
+                    type=int,
+                    default=1,
+                    help='regions to run, each with its own server and redis-servers, kept in sync by anti-entropy (default 1)')
+
+parser.add_argument('--mode',
+                    dest='mode',
+                    action='store',
+                    nargs='?',
+                    default=None,
+                    help='server mode to test, e.g. gevent (default blocking)')
+
+parser.add_argument('--buffer',
+                    action='store_true',
+                    help='run the server with its write-behind buffer on')
+
+parser.add_argument('--siblings',
+                    choices=['fold', 'reject'],
+                    default=None,
+                    help='cap the siblings per entity with this policy')
+
+parser.add_argument('--prune',
+                    action='store_true',
+                    help='run the server with clock pruning on')
+
+parser.add_argument('--metrics',
+                    action='store_true',
+                    help='run the server with its instrumentation on')
+
+parser.add_argument('--cache',
+                    action='store_true',
+                    help='run the server with its read cache on')
+
+parser.add_argument('--jobs',
+                    type=int,
+                    default=4,
+                    help='tests to run at the same time (default 4)')
+
 parser.add_argument('--test',
                     dest='test',
                     action='store',
@@ -69,6 +157,57 @@ parser.add_argument('--test',
                     default=None,
                     help='name of single test to run')
 
+bench = parser.add_argument_group('benchmark', 'drive the server with a synthetic load instead of running the tests')
+
+bench.add_argument('--bench',
+                   action='store_true',
+                   help='run the benchmark')
+
+bench.add_argument('--clients',
+                   type=int,
+                   default=8,
+                   help='concurrent clients (default 8)')
+
+bench.add_argument('--requests',
+                   type=int,
+                   default=2000,
+                   help='requests across all clients (default 2000)')
+
+bench.add_argument('--entities',
+                   type=int,
+                   default=1000,
+                   help='entities to spread requests over (default 1000)')
+
+bench.add_argument('--zipf',
+                   type=float,
+                   default=1.0,
+                   help='Zipf skew of entity popularity, 0 for uniform (default 1.0)')
+
+bench.add_argument('--reads',
+                   type=float,
+                   default=0.8,
+                   help='fraction of requests that are GETs (default 0.8)')
+
+bench.add_argument('--ids',
+                   type=int,
+                   default=16,
+                   help='client ids that appear in clocks (default 16)')
+
+bench.add_argument('--width',
+                   type=int,
+                   default=4,
+                   help='most nodes in a written clock (default 4)')
+
+bench.add_argument('--stale',
+                   type=float,
+                   default=0.05,
+                   help='fraction of writes that resend an older clock (default 0.05)')
+
+bench.add_argument('--concurrent',
+                   type=float,
+                   default=0.05,
+                   help='fraction of writes from a client that has seen nothing (default 0.05)')
+
 args = parser.parse_args()
 if args.output:
 	url = urlparse.urlparse(args.output)
@@ -76,15 +215,51 @@ if args.output:
 		output = file(url.path, 'w')
 	else:
 		output = HTTPOutput(urlparse.urlunparse(url))
+		atexit.register(output.close)
 else:
 	output = sys.stdout
 
 # Seed the random number generator with a known value
 random.seed(args.key)
 
-n = 1  # Only a single server in this assignment
+n = args.shards
 port = 5555
 
+# Most Redis commands a single GET or PUT may cost; with the read cache on,
+# a GET of a record that changed since it was cached checks the version first
+GET_BUDGET = 2 if args.cache else 1
+PUT_BUDGET = 3
+
+# With peers, the merge script also keeps the entity's digest up to date
+if args.regions > 1: PUT_BUDGET += 3
+
+# Most keys the fullest shard may hold, relative to an even spread
+SPREAD_BUDGET = 1.3
+
+# How often a buffering server flushes to Redis, in seconds, and how many
+# PUTs the hot entity test sends
+BUFFER_INTERVAL = 0.05
+HOT_WRITES = 100
+
+# Longest a replica takes to catch up with its primary, in seconds
+REPLICA_LAG = 0.2
+
+# Most siblings an entity may hold when the server caps them
+SIBLING_LIMIT = 4
+
+# Most nodes a clock may hold when the server prunes them
+PRUNE_WIDTH = 3
+
+# Seconds between anti-entropy rounds; long, as the tests ask for rounds
+# when they want them. Entities the anti-entropy test writes in one region.
+ANTIENTROPY_INTERVAL = 3600
+ENTROPY_ENTITIES = 200
+
+# Entities the snapshot test exports, and records per round trip, small
+# enough that there are several batches
+SNAPSHOT_ENTITIES = 100
+SNAPSHOT_BATCH = 16
+
 base = os.path.dirname(os.path.abspath(os.path.join(__file__, '..')))
 log = os.path.join(base, 'var', 'log')
 db = os.path.join(base, 'var', 'db')
@@ -95,30 +270,80 @@ if os.path.exists(db): shutil.rmtree(db)
 os.makedirs(log)
 os.makedirs(db)
 
-configs = [ { 'id': str(i), 'host': 'localhost', 'port': port+i } for i in range(n) ]
-processes =	[ subprocess.Popen(['redis-server',
-                                '--port', str(config['port']),
-                                '--bind', '127.0.0.1',
-                                '--logfile', os.path.join(log, 'server'+config['id']+'.log'),
-                                '--dbfilename', 'server'+config['id']+'.rdb',
-                                '--databases', '1',
-                                '--dir', db ])
-                                for config in configs ]
+# The redis-servers of a region, on ports 1000 apart per region: its shards,
+# then the read replicas of each shard on ports above the primaries'. Redis
+# replicates to them asynchronously.
+def start(region):
+	first = port+1000*region
+	prefix = 'region%d-' % region if region else ''
+	configs = [ { 'id': str(i), 'host': 'localhost', 'port': first+i } for i in range(n) ]
+	for i, config in enumerate(configs):
+		config['replicas'] = [ { 'host': 'localhost', 'port': first+n*(j+1)+i } for j in range(args.replicas) ]
+	names = [ (prefix+'server'+config['id'], config['port'], [ ]) for config in configs ]
+	names += [ (prefix+'server%s-replica%d' % (config['id'], j), replica['port'], [ '--replicaof', '127.0.0.1', str(config['port']) ])
+	           for config in configs for j, replica in enumerate(config['replicas']) ]
+	processes = [ subprocess.Popen(['redis-server',
+	                                '--port', str(number),
+	                                '--bind', '127.0.0.1',
+	                                '--logfile', os.path.join(log, name+'.log'),
+	                                '--dbfilename', name+'.rdb',
+	                                '--databases', '1',
+	                                '--dir', db ] + extra)
+	              for name, number, extra in names ]
+	return configs, processes
+
+regions = [ start(region) for region in range(args.regions) ]
+configs = regions[0][0]
+processes = [ p for _, started in regions for p in started ]
 clients = [ redis.StrictRedis(host=config['host'], port=config['port'], db=0) for config in configs ]
+replicaClients = [ redis.StrictRedis(host=replica['host'], port=replica['port'], db=0) for config in configs for replica in config['replicas'] ]
+# The shards of every region, cleared between tests
+regionClients = [ redis.StrictRedis(host=config['host'], port=config['port'], db=0) for region, _ in regions for config in region ]
+
+# A server per region, on ports 2500 and up, each with every other as a peer
+endpoints = [ 'http://localhost:%d' % (2500+region) for region in range(args.regions) ]
+servers, serverconfigs = [ ], [ ]
+for region, (regionconfigs, _) in enumerate(regions):
+	serverconfig = { 'servers': regionconfigs, 'mode': args.mode }
+	if args.buffer: serverconfig['buffer'] = { 'interval': BUFFER_INTERVAL }
+	if args.cache: serverconfig['cache'] = { 'size': 1000 }
+	if args.siblings: serverconfig['siblings'] = { 'limit': SIBLING_LIMIT, 'policy': args.siblings }
+	if args.prune: serverconfig['pruning'] = { 'width': PRUNE_WIDTH }
+	if args.metrics: serverconfig['metrics'] = True
+	if args.regions > 1:
+		serverconfig['peers'] = [ { 'url': url } for url in endpoints if url != endpoints[region] ]
+		serverconfig['antientropy'] = { 'interval': ANTIENTROPY_INTERVAL }
+	servers.append(subprocess.Popen(['python', os.path.join(base, 'server.py'), json.dumps(serverconfig)], env=dict(os.environ, PORT=str(2500+region))))
+	serverconfigs.append(serverconfig)
 
-server = subprocess.Popen(['python', os.path.join(base, 'server.py'), json.dumps({ 'servers': configs })])
 ITEM = 'bob'
-endpoint = 'http://localhost:2500'
+endpoint = endpoints[0]
 
-def get(id):
-	headers = { 'Accept': 'application/json' }
-	url = endpoint+'/rating/'+id
+# The test running on this thread: its entities live under their own prefix,
+# so tests running at the same time never touch each other's records
+local = threading.local()
+
+def entity(id):
+	return getattr(local, 'namespace', '') + id
+
+# Headers asking to see at least the version the last PUT to id returned, so
+# that a lagging replica never hides the test's own writes
+def seen(id):
+	versions = getattr(local, 'versions', { })
+	return { 'X-Min-Version': str(versions[id]) } if versions.get(id) else { }
+
+def get(id, at=None):
+	headers = dict({ 'Accept': 'application/json' }, **seen(id))
+	url = (at or endpoint)+'/rating/'+entity(id)
 	try:
 		request = requests.get(url, headers=headers)
 		data = request.json()
 	except:
 		raise Exception('Invalid request: %s HTTP %d  %s' % (url, request.status_code, request.text))
 
+	return decode(data)
+
+def decode(data):
 	try:
 		rating = float(data['rating'])
 	except:
@@ -129,14 +354,55 @@ def get(id):
 	clocks = json.load(StringIO.StringIO(data['clocks']))
 	return rating, choices, [VectorClock.fromDict(vcstr) for vcstr in clocks]
 
-def put(id, rating, clock):
+def put(id, rating, clock, at=None):
 	headers = { 'Accept': 'application/json', 'Content-type': 'application/json' }
 	data = json.dumps({ 'rating': rating, 'clocks': clock.clock })
-	requests.put(endpoint+'/rating/'+id, headers=headers, data=data)
+	response = requests.put((at or endpoint)+'/rating/'+entity(id), headers=headers, data=data)
+	if response.ok and hasattr(local, 'versions'):
+		local.versions[id] = response.json().get('version')
+	return response
+
+def summary(id):
+	return requests.get(endpoint+'/rating/'+entity(id), headers=dict({ 'Accept': 'application/json' }, **seen(id))).json()['summary']
+
+# GET an entity sending tag in If-None-Match; returns the raw response
+def conditional(id, tag):
+	return requests.get(endpoint+'/rating/'+entity(id), headers=dict({ 'Accept': 'application/json', 'If-None-Match': tag }, **seen(id)))
+
+def delete(id, at=None):
+	requests.delete((at or endpoint)+'/rating/'+entity(id))
+
+def stats(at=None):
+	return requests.get((at or endpoint)+'/stats').json()
+
+# Run an anti-entropy round on the server at at; returns the records it pulled
+def sync(at):
+	before = stats(at)['antientropy']['pulled']
+	return requests.post(at+'/antientropy').json()['pulled'] - before
+
+# The server's metrics as a dictionary of sample => value, or None if off
+def scrape():
+	request = requests.get(endpoint+'/metrics')
+	if request.status_code == 404: return None
+	return dict(line.rsplit(' ', 1) for line in request.text.splitlines() if line and not line.startswith('#'))
+
+def getMany(ids):
+	headers = { 'Accept': 'application/json' }
+	request = requests.get(endpoint+'/ratings', headers=headers, params={ 'entity': map(entity, ids) })
+	return [ decode(data) for data in request.json()['results'] ]
+
+def putMany(records):
+	headers = { 'Accept': 'application/json', 'Content-type': 'application/json' }
+	data = json.dumps([ { 'entity': entity(id), 'rating': rating, 'clocks': clock.clock } for id, rating, clock in records ])
+	return requests.put(endpoint+'/ratings', headers=headers, data=data).json()['results']
+
+# Tests on different threads report at the same time
+outputLock = threading.Lock()
 
 def result(r):
-	output.write(json.dumps(r)+'\n')
-	output.flush()
+	with outputLock:
+		output.write(json.dumps(r)+'\n')
+		output.flush()
 
 def testResult(result, rgot, rexp, choicesgot, choicesexp, clocksgot, clocksexp):
     result({ 'type': 'EXPECT_RATING', 'got': rgot, 'expected': rexp})
@@ -147,19 +413,45 @@ def getAndTest(result, item, rexp, choicesexp, clocksexp):
     r, ch, cl = get(item)
     testResult(result, r, rexp, ch, choicesexp, cl, clocksexp)
 
+def summaryTest(result, item, count, low, high, variance):
+    got = summary(item)
+    expected = { 'count': count, 'min': low, 'max': high, 'variance': variance }
+    for field in sorted(expected):
+        result({ 'type': 'EXPECT_SUMMARY', 'field': field, 'got': got[field], 'expected': expected[field] })
+
 def makeVC(cl, count):
     return VectorClock().update(cl, count)
 
 def info(msg):
-	sys.stdout.write(colored('ℹ', 'green')+' '+msg+'\n')
-	sys.stdout.flush()
+	with outputLock:
+		sys.stdout.write(colored('ℹ', 'green')+' '+msg+'\n')
+		sys.stdout.flush()
+
+# Give a buffering server time to write out the PUTs it holds, and the
+# replicas time to catch up with their primaries
+def settle():
+	if args.buffer: time.sleep(10*BUFFER_INTERVAL)
+	if args.replicas: time.sleep(REPLICA_LAG)
 
 def flush():
-	for client in clients:
+	settle()
+	for client in regionClients:
 		client.flushall()
 
-def count():
-	return sum(map(lambda c:c.info()['total_commands_processed'],clients))
+def count(servers=None):
+	return sum(map(lambda c:c.info()['total_commands_processed'],clients+replicaClients if servers is None else servers))
+
+# Count the Redis commands (including those run by scripts) issued by f,
+# net of the INFO commands count() itself sends. PUTs are counted on the
+# primaries alone: a replica counts again every write relayed to it, while
+# GETs may be served by either.
+def commands(f, *a, **kwargs):
+	servers = kwargs.get('servers')
+	before = count(servers)
+	overhead = count(servers) - before
+	start = count(servers)
+	f(*a)
+	return count(servers) - start - overhead
 
 def sum(l):
 	return reduce(lambda s,a: s+a, l, float(0))
@@ -174,10 +466,10 @@ def variance(l):
 def stddev(l):
 	return math.sqrt(mean(variance(l)))
 
+# Keys each shard holds for the entities of the test on this thread
 def usage():
-	def u(i):
-		return i['db0']['keys'] if 'db0' in i else 0
-	return [ u(c.info()) for c in clients ]
+	pattern = '/rating/'+entity('*')
+	return [ len(list(c.scan_iter(match=pattern))) for c in clients ]
 
 
 print("Running test #"+args.key)
@@ -186,11 +478,27 @@ print("Running test #"+args.key)
 result({ 'name': 'info', 'type': 'KEY', 'value': args.key })
 result({ 'name': 'info', 'type': 'SHARD_COUNT', 'value': n })
 
-# Give the server some time to start up
+# Give the servers and redis-servers some time to start up; with several
+# regions that can take longer than a second
+def up(check):
+	try:
+		return check()
+	except (redis.ConnectionError, requests.ConnectionError):
+		return False
+
+def ready():
+	return all(up(client.ping) for client in regionClients+replicaClients) and all(up(lambda: requests.get(url+'/stats').ok) for url in endpoints)
+
 time.sleep(1)
+deadline = time.time() + 10
+while not ready() and time.time() < deadline:
+	time.sleep(0.1)
 
+# Tests only touch entities in their own namespace, so they can run at the
+# same time. Exclusive tests measure the whole server (command counts, key
+# counts, cache and metric deltas) and run alone on a clean database.
 tests = [ ]
-def test():
+def test(exclusive=False):
 	def wrapper(f):
 		def rx(obj):
 			x = obj.copy()
@@ -199,11 +507,18 @@ def test():
 		@functools.wraps(f)
 		def wrapped(*a):
 			info("Running test %s" % (f.__name__))
-			# Clean the database before subsequent tests
-			flush()
-			# Reset the RNG to a known value
-			random.seed(args.key+'/'+f.__name__)
-			f(rx, *a)
+			if exclusive: flush()
+			local.namespace = f.__name__+':'
+			local.versions = { }
+			# Tests run side by side on the pool's threads, so each draws from
+			# its own generator, seeded from the key and its name, rather than
+			# from the shared random module
+			local.random = random.Random('%s/%s' % (args.key, f.__name__))
+			try:
+				f(rx, *a)
+			finally:
+				del local.namespace, local.versions, local.random
+		wrapped.exclusive = exclusive
 		tests.append(wrapped)
 		return wrapped
 	return wrapper
@@ -304,14 +619,419 @@ def longerSequence(result):
     put(ITEM, 18, vc4_5_23_bis)
     getAndTest(result, ITEM, 18, [18], [vc4_5_23_bis])
 
-# Go through all the tests and run them
+@test()
+def bulkRatings(result):
+    # Bulk writes merge exactly like single PUTs, in order
+    vc1 = makeVC('c0', 5)
+    vc2 = makeVC('c1', 3)
+    vc3 = makeVC('c0', 7).update('c1', 10)
+    putMany([ ('tea-a', 5, vc1), ('tea-b', 5, vc1), ('tea-a', 2, vc2),
+              ('tea-b', 2, vc2), ('tea-b', 3, vc3), ('tea-a', 1, makeVC('c0', 1)) ])
+    (ra, choicesa, clocksa), (rb, choicesb, clocksb) = getMany([ 'tea-a', 'tea-b' ])
+    testResult(result, ra, 3.5, choicesa, [5, 2], clocksa, [vc1, vc2])
+    testResult(result, rb, 3, choicesb, [3], clocksb, [vc3])
+    # Bulk reads agree with single GETs
+    r, choices, clocks = get('tea-a')
+    testResult(result, ra, r, choicesa, choices, clocksa, clocks)
+
+@test()
+def ratingPrecision(result):
+    # A PUT answers with the same rating, as a number, that a GET returns,
+    # whichever route it came in by. The write buffer does not read the
+    # stored record, so while it holds a write the rating is null.
+    ratings = [ put('latte', 0.1, makeVC('c0', 1)).json()['rating'], put('latte', 0.2, makeVC('c1', 1)).json()['rating'] ]
+    ratings += [ item['rating'] for item in putMany([ ('latte-bulk', 0.1, makeVC('c0', 1)), ('latte-bulk', 0.2, makeVC('c1', 1)) ]) ]
+    stored = [ requests.get(endpoint+'/rating/'+entity(id), headers=dict({ 'Accept': 'application/json' }, **seen(id))).json()['rating'] for id in ('latte', 'latte-bulk') ]
+    exact = [ rating == (0.1+0.2)/2 for rating in stored ]
+    if args.buffer:
+        exact += [ rating is None for rating in ratings ]
+    else:
+        exact += [ isinstance(rating, float) for rating in ratings ] + [ ratings[1] == stored[0], ratings[3] == stored[1] ]
+    result({ 'type': 'EXPECT_RATING', 'got': exact, 'expected': [ True ] * len(exact) })
+
+@test()
+def invalidRatings(result):
+    # NaN, the infinities and ratings too large to hold exactly are refused,
+    # alone and in bulk, without touching the record
+    vc = makeVC('c0', 1)
+    put('cocoa', 4, vc)
+    invalid = [ float('nan'), float('inf'), float('-inf'), 1.7e308, 2**53 ]
+    statuses = [ put('cocoa', rating, makeVC('c0', 2)).status_code for rating in invalid ]
+    result({ 'type': 'EXPECT_STATUSES', 'got': statuses, 'expected': [ 400 ] * len(invalid) })
+    results = putMany([ ('cocoa-%d' % i, rating, vc) for i, rating in enumerate(invalid) ] + [ ('cocoa-ok', 3, vc) ])
+    result({ 'type': 'EXPECT_STATUSES', 'got': [ item.get('error') for item in results ], 'expected': [ 400 ] * len(invalid) + [ None ] })
+    getAndTest(result, 'cocoa', 4, [4], [vc])
+    getAndTest(result, 'cocoa-ok', 3, [3], [vc])
+
+@test()
+def largeCounters(result):
+    # Clock counters are held exactly only below 2**53; larger ones are
+    # refused rather than stored as a different counter
+    largest = makeVC('c0', 2**53 - 1)
+    statuses = [ put('mocha', 4, makeVC('c0', counter)).status_code for counter in (2**53, 2**53 + 1, 2**62 + 1, 2**53 - 1) ]
+    result({ 'type': 'EXPECT_STATUSES', 'got': statuses, 'expected': [ 400, 400, 400, 200 ] })
+    getAndTest(result, 'mocha', 4, [4], [largest])
+    results = putMany([ ('mocha-big', 3, makeVC('c1', 2**62 + 1)), ('mocha-ok', 3, largest) ])
+    result({ 'type': 'EXPECT_STATUSES', 'got': [ item.get('error') for item in results ], 'expected': [ 400, None ] })
+
+@test(exclusive=True)
+def commandBudget(result):
+    # Every GET and PUT should stay within a fixed number of Redis commands
+    put(ITEM, 5, makeVC('c0', 1)) # Warm up so the merge script is loaded
+    settle()
+    used = commands(put, ITEM, 3, makeVC('c0', 2), servers=clients)
+    result({ 'type': 'EXPECT_COMMANDS', 'got': used, 'expected': PUT_BUDGET })
+    settle()
+    used = commands(put, ITEM, 1, makeVC('c0', 1), servers=clients)
+    result({ 'type': 'EXPECT_COMMANDS', 'got': used, 'expected': PUT_BUDGET })
+    settle()
+    used = commands(put, ITEM, 2, makeVC('c1', 4), servers=clients)
+    result({ 'type': 'EXPECT_COMMANDS', 'got': used, 'expected': PUT_BUDGET })
+    settle()
+    used = commands(get, ITEM)
+    result({ 'type': 'EXPECT_COMMANDS', 'got': used, 'expected': GET_BUDGET })
+
+@test()
+def shardSpread(result):
+    # Entities should land on every shard in roughly equal numbers
+    for i in range(200*n):
+        put('entity%d' % i, 3, makeVC('c0', 1))
+    settle()
+    keys = usage()
+    result({ 'type': 'EXPECT_SHARD_LOAD', 'got': max(keys)/mean(keys), 'expected': SPREAD_BUDGET, 'keys': keys })
+
+@test(exclusive=True)
+def hotEntity(result):
+    # A burst of PUTs to one entity; with the write buffer on it should cost
+    # Redis work per flush rather than per request. GETs see every write.
+    used = commands(lambda: [ put(ITEM, i % 5, makeVC('c0', i+1)) for i in range(HOT_WRITES) ], servers=clients)
+    budget = HOT_WRITES*PUT_BUDGET/10 if args.buffer else HOT_WRITES*PUT_BUDGET
+    result({ 'type': 'EXPECT_COMMANDS', 'got': used, 'expected': budget })
+    put(ITEM, 2, makeVC('c1', 1))
+    getAndTest(result, ITEM, 3, [4, 2], [makeVC('c0', HOT_WRITES), makeVC('c1', 1)])
+    settle()
+    getAndTest(result, ITEM, 3, [4, 2], [makeVC('c0', HOT_WRITES), makeVC('c1', 1)])
+
+@test(exclusive=True)
+def readCache(result):
+    # Repeated GETs can be served from the cache, but never after a write
+    # or a DELETE has changed the record
+    hits = stats()['cache']['hits'] if args.cache else 0
+    vc1 = makeVC('c0', 1)
+    put(ITEM, 5, vc1)
+    settle()
+    for i in range(3):
+        getAndTest(result, ITEM, 5, [5], [vc1])
+    vc2 = makeVC('c1', 1)
+    put(ITEM, 2, vc2)
+    settle()
+    getAndTest(result, ITEM, 3.5, [5, 2], [vc1, vc2])
+    delete(ITEM)
+    put(ITEM, 4, vc1)
+    settle()
+    getAndTest(result, ITEM, 4, [4], [vc1])
+    if args.cache:
+        result({ 'type': 'EXPECT_CACHE_HITS', 'got': stats()['cache']['hits'] - hits, 'expected': 2 })
+
+@test()
+def ratingSummary(result):
+    # The count, extremes and variance of the choices follow siblings being
+    # added and dominated
+    put(ITEM, 5, makeVC('c0', 1))
+    put(ITEM, 2, makeVC('c1', 1))
+    put(ITEM, 4, makeVC('c2', 1))
+    summaryTest(result, ITEM, 3, 2.0, 5.0, 14/9.0)
+    put(ITEM, 1, makeVC('c0', 2))
+    summaryTest(result, ITEM, 3, 1.0, 4.0, 14/9.0)
+    vc = makeVC('c0', 3).update('c1', 3).update('c2', 3)
+    put(ITEM, 3, vc)
+    summaryTest(result, ITEM, 1, 3.0, 3.0, 0.0)
+    getAndTest(result, ITEM, 3, [3], [vc])
+
+@test()
+def siblingCap(result):
+    # Clients that never see each other's writes; with the cap on, the entity
+    # holds no more than SIBLING_LIMIT siblings however many they send
+    writes = SIBLING_LIMIT + 2
+    statuses = [ put(ITEM, i, makeVC('c%d' % i, 1)).status_code for i in range(writes) ]
+    settle()
+    result({ 'type': 'EXPECT_SIBLINGS', 'got': summary(ITEM)['count'], 'expected': SIBLING_LIMIT if args.siblings else writes })
+    if args.siblings == 'reject' and not args.buffer:
+        result({ 'type': 'EXPECT_STATUSES', 'got': statuses, 'expected': [200]*SIBLING_LIMIT + [409]*2 })
+        getAndTest(result, ITEM, 1.5, [0, 1, 2, 3], [makeVC('c%d' % i, 1) for i in range(SIBLING_LIMIT)])
+    if args.siblings == 'fold' and not args.buffer:
+        # Each write past the cap folds the two oldest siblings together
+        folded = makeVC('c0', 1).update('c1', 1).update('c2', 1)
+        getAndTest(result, ITEM, 3.3125, [1.25, 3, 4, 5], [folded] + [makeVC('c%d' % i, 1) for i in range(3, writes)])
+    if args.siblings:
+        result({ 'type': 'EXPECT_CAPPED', 'got': stats()['siblings']['capped'] > 0, 'expected': True })
+
+@test()
+def clockPruning(result):
+    # Clients c0..c5 take turns to read the entity and write over it. With
+    # pruning on, only the PRUNE_WIDTH most recently advanced nodes stay in
+    # the clock, and c0's first write, long since overwritten, then looks
+    # concurrent rather than stale.
+    writers = 6
+    vc = VectorClock()
+    for i in range(writers):
+        vc = VectorClock.fromDict(dict(vc.asDict(), **{ 'c%d' % i: 1 }))
+        put(ITEM, i, vc)
+        settle()
+        r, choices, clocks = get(ITEM)
+        vc = clocks[0]
+    kept = range(writers - PRUNE_WIDTH, writers) if args.prune else range(writers)
+    result({ 'type': 'EXPECT_NODES', 'got': len(vc.asDict()), 'expected': len(kept) })
+    result({ 'type': 'EXPECT_NEWEST_NODES', 'got': sorted(vc.asDict().keys()) == [ 'c%d' % i for i in kept ], 'expected': True })
+    put(ITEM, 0, makeVC('c0', 1))
+    settle()
+    r, choices, clocks = get(ITEM)
+    result({ 'type': 'EXPECT_SIBLINGS', 'got': len(choices), 'expected': 2 if args.prune else 1 })
+    if args.prune:
+        result({ 'type': 'EXPECT_PRUNES', 'got': stats()['clocks']['prunes'] >= writers - PRUNE_WIDTH, 'expected': True })
+
+def percentile(ordered, p):
+    return ordered[min(int(p*len(ordered)), len(ordered)-1)] if ordered else None
+
+# Entities by popularity; entity k is picked with weight 1/(k+1)^zipf
+def popularity(entities, skew):
+    total, cumulative = 0.0, [ ]
+    for k in range(entities):
+        total += 1.0/(k+1)**skew
+        cumulative.append(total)
+    return cumulative
+
+def benchmark():
+    info("Running benchmark")
+    flush()
+    cumulative = popularity(args.entities, args.zipf)
+    counter = itertools.count(1)  # every written counter is new
+    latencies = { 'get': [ ], 'put': [ ] }
+    errors = [ 0 ]
+    lock = threading.Lock()
+
+    def client(i, requestCount):
+        rng = random.Random('%s/%d' % (args.key, i))
+        session = requests.Session()
+        known, previous = { }, { }  # entity => clock dictionary
+        timings = { 'get': [ ], 'put': [ ] }
+        failed = 0
+        for _ in xrange(requestCount):
+            entity = 'entity%d' % bisect.bisect_left(cumulative, rng.random()*cumulative[-1])
+            url = endpoint+'/rating/'+entity
+            if rng.random() < args.reads:
+                op = 'get'
+                start = time.time()
+                response = session.get(url, headers={ 'Accept': 'application/json' })
+                elapsed = time.time() - start
+                clocks = response.json().get('clocks') if response.ok else None
+                if clocks:
+                    seen = VectorClock.converge(VectorClock.fromDict(clock) for clock in json.loads(clocks))
+                    known[entity] = VectorClock.converge([ VectorClock.fromDict(known.get(entity, { })), seen ]).asDict()
+            else:
+                op = 'put'
+                draw = rng.random()
+                if draw < args.stale and entity in previous:
+                    clock = previous[entity]
+                elif draw < args.stale + args.concurrent:
+                    clock = { 'c%d' % rng.randrange(args.ids): next(counter) }
+                else:
+                    # Advance our own id over the newest entries we know of
+                    mine = 'c%d' % rng.randrange(args.ids)
+                    others = sorted((count, node) for node, count in known.get(entity, { }).iteritems() if node != mine)
+                    clock = dict((node, count) for count, node in (others[-(args.width-1):] if args.width > 1 else [ ]))
+                    clock[mine] = next(counter)
+                    previous[entity], known[entity] = known.get(entity, clock), clock
+                data = json.dumps({ 'rating': rng.randint(1, 5), 'clock': clock })
+                start = time.time()
+                response = session.put(url, data=data, headers={ 'Accept': 'application/json', 'Content-type': 'application/json' })
+                elapsed = time.time() - start
+            if not response.ok: failed += 1
+            timings[op].append(elapsed)
+        with lock:
+            for op in timings: latencies[op].extend(timings[op])
+            errors[0] += failed
+
+    shares = [ args.requests//args.clients + (1 if i < args.requests % args.clients else 0) for i in range(args.clients) ]
+    threads = [ threading.Thread(target=client, args=(i, share)) for i, share in enumerate(shares) ]
+    # Primaries only, as for the PUT budgets: a replica counts every write
+    # relayed to it again
+    before = count(clients)
+    overhead = count(clients) - before
+    start = time.time()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.time() - start
+    settle()
+    used = count(clients) - before - 2*overhead
+
+    workload = dict((name, getattr(args, name)) for name in ('clients', 'requests', 'entities', 'zipf', 'reads', 'ids', 'width', 'stale', 'concurrent'))
+    workload.update({ 'mode': args.mode, 'shards': n, 'buffer': args.buffer, 'cache': args.cache })
+    result({ 'name': 'bench', 'type': 'BENCH_WORKLOAD', 'value': workload })
+    result({ 'name': 'bench', 'type': 'BENCH_THROUGHPUT', 'value': args.requests/elapsed, 'seconds': elapsed, 'errors': errors[0] })
+    for op in ('get', 'put'):
+        ordered = sorted(latencies[op])
+        result({ 'name': 'bench', 'type': 'BENCH_LATENCY', 'op': op, 'requests': len(ordered),
+                 'p50': percentile(ordered, 0.5), 'p95': percentile(ordered, 0.95), 'p99': percentile(ordered, 0.99) })
+    result({ 'name': 'bench', 'type': 'BENCH_COMMANDS', 'value': float(used)/args.requests })
+    info("%.0f requests/s, %.2f Redis commands per request" % (args.requests/elapsed, float(used)/args.requests))
+
+@test(exclusive=True)
+def instrumentation(result):
+    # With metrics on, requests are timed and merge outcomes counted; with
+    # them off there is no metrics route at all
+    before = scrape() or { }
+    put(ITEM, 5, makeVC('c0', 2))
+    put(ITEM, 2, makeVC('c0', 1))
+    put(ITEM, 3, makeVC('c1', 1))
+    put(ITEM, 4, makeVC('c0', 3).update('c1', 2))
+    settle()
+    get(ITEM)
+    after = scrape()
+    result({ 'type': 'EXPECT_METRICS', 'got': after is not None, 'expected': args.metrics })
+    if after is None: return
+    def grew(sample):
+        return float(after.get(sample, 0)) - float(before.get(sample, 0))
+    result({ 'type': 'EXPECT_TIMED_GETS', 'got': grew('rating_request_seconds_count{route="GET /rating/<entity>"}'), 'expected': 1 })
+    result({ 'type': 'EXPECT_TIMED_PUTS', 'got': grew('rating_request_seconds_count{route="PUT /rating/<entity>"}'), 'expected': 4 })
+    if not args.buffer:
+        # Buffered writes are merged in memory before they reach the script
+        result({ 'type': 'EXPECT_STALE', 'got': grew('rating_merges_total{outcome="stale"}'), 'expected': 1 })
+        result({ 'type': 'EXPECT_CONCURRENT', 'got': grew('rating_merges_total{outcome="concurrent"}'), 'expected': 2 })
+        result({ 'type': 'EXPECT_SUPERSEDED', 'got': grew('rating_superseded_siblings_total'), 'expected': 2 })
+        result({ 'type': 'EXPECT_GET_COMMANDS', 'got': grew('rating_request_redis_commands_sum{route="GET /rating/<entity>"}'), 'expected': GET_BUDGET })
+
+@test()
+def conditionalGet(result):
+    # A GET carries an ETag of the siblings; sent back, it gets an empty 304
+    # for as long as the siblings stay the same
+    put(ITEM, 5, makeVC('c0', 2))
+    settle()
+    tag = conditional(ITEM, '"none"').headers.get('ETag')
+    result({ 'type': 'EXPECT_ETAG', 'got': tag is not None, 'expected': True })
+    unchanged = conditional(ITEM, tag)
+    result({ 'type': 'EXPECT_STATUS', 'got': unchanged.status_code, 'expected': 304 })
+    result({ 'type': 'EXPECT_EMPTY', 'got': len(unchanged.content), 'expected': 0 })
+    put(ITEM, 1, makeVC('c0', 1)) # Stale, so nothing changes
+    result({ 'type': 'EXPECT_STATUS', 'got': conditional(ITEM, tag).status_code, 'expected': 304 })
+    put(ITEM, 3, makeVC('c1', 1))
+    changed = conditional(ITEM, tag)
+    result({ 'type': 'EXPECT_STATUS', 'got': changed.status_code, 'expected': 200 })
+    result({ 'type': 'EXPECT_NEW_ETAG', 'got': changed.headers.get('ETag') not in (None, tag), 'expected': True })
+    r, choices, clocks = decode(changed.json())
+    testResult(result, r, 4, choices, [5, 3], clocks, [makeVC('c0', 2), makeVC('c1', 1)])
+    # The ETag of buffered writes is the one stored once they are flushed
+    settle()
+    result({ 'type': 'EXPECT_STATUS', 'got': conditional(ITEM, changed.headers.get('ETag')).status_code, 'expected': 304 })
+
+@test()
+def replicaReads(result):
+    # GETs are spread over the replicas; sending the version a PUT returned
+    # still always shows that write, however far the replicas lag
+    before = stats()['replicas'] or { }
+    vc1 = makeVC('c0', 1)
+    first = put(ITEM, 5, vc1).json()['version']
+    getAndTest(result, ITEM, 5, [5], [vc1])
+    vc2 = makeVC('c0', 2)
+    second = put(ITEM, 3, vc2).json()['version']
+    getAndTest(result, ITEM, 3, [3], [vc2])
+    # The buffer holds the writes, so there is no version yet
+    result({ 'type': 'EXPECT_VERSIONS', 'got': first is not None and second > first, 'expected': not args.buffer })
+    for i in range(4):
+        get(ITEM)
+    after = stats()['replicas'] or { }
+    result({ 'type': 'EXPECT_REPLICA_READS', 'got': after.get('replica', 0) - before.get('replica', 0) >= 4, 'expected': args.replicas > 0 })
+
+@test(exclusive=True)
+def antiEntropy(result):
+    # Regions take writes on their own; a round pulls only the records that
+    # differ from a peer's, after which both hold the merged siblings
+    result({ 'type': 'EXPECT_ANTIENTROPY', 'got': stats()['antientropy'] is not None, 'expected': args.regions > 1 })
+    if args.regions < 2: return
+    first, second = endpoints[:2]
+    for i in range(ENTROPY_ENTITIES):
+        put('entity%d' % i, 3, makeVC('c0', 1), at=first)
+    vc1, vc2 = makeVC('c0', 2), makeVC('c1', 1)
+    put(ITEM, 5, vc1, at=first)
+    put(ITEM, 2, vc2, at=second)
+    settle()
+    pulled = [ sync(second), sync(first), sync(second), sync(first) ]
+    result({ 'type': 'EXPECT_PULLED', 'got': pulled, 'expected': [ENTROPY_ENTITIES+1, 1, 0, 0] })
+    for at in (first, second):
+        r, choices, clocks = get(ITEM, at=at)
+        testResult(result, r, 3.5, choices, [5, 2], clocks, [vc1, vc2])
+    # One more write costs one record, not another full exchange
+    vc3 = makeVC('c0', 2)
+    put('entity7', 4, vc3, at=first)
+    settle()
+    result({ 'type': 'EXPECT_PULLED', 'got': sync(second), 'expected': 1 })
+    r, choices, clocks = get('entity7', at=second)
+    testResult(result, r, 4, choices, [4], clocks, [vc3])
+    # There are no tombstones: a record deleted in one region only comes
+    # back from the others
+    delete('entity7', at=first)
+    result({ 'type': 'EXPECT_PULLED', 'got': sync(first), 'expected': 1 })
+    r, choices, clocks = get('entity7', at=first)
+    testResult(result, r, 4, choices, [4], clocks, [vc3])
+
+@test(exclusive=True)
+def snapshots(result):
+    # Exporting every rating and importing it into an empty database, in
+    # either format, restores them all; importing over newer ratings merges
+    # by the clock rules and changes nothing
+    vc1, vc2, vc3 = makeVC('c0', 2), makeVC('c1', 1), makeVC('c0', 3)
+    for format in sorted(snapshot.WRITERS):
+        flush()
+        put(ITEM, 5, vc1)
+        put(ITEM, 2, vc2)
+        putMany([ ('entity%d' % i, i % 5, makeVC('c0', 1)) for i in range(SNAPSHOT_ENTITIES) ])
+        settle()
+        out = StringIO.StringIO()
+        exported = snapshot.export(clients, snapshot.WRITERS[format](out), SNAPSHOT_BATCH)
+        result({ 'type': 'EXPECT_EXPORTED', 'format': format, 'got': exported, 'expected': SNAPSHOT_ENTITIES+1 })
+        flush()
+        imported = snapshot.Importer(serverconfigs[0], SNAPSHOT_BATCH).run(snapshot.read(StringIO.StringIO(out.getvalue())))
+        result({ 'type': 'EXPECT_IMPORTED', 'format': format, 'got': imported['records'], 'expected': SNAPSHOT_ENTITIES+1 })
+        settle()
+        getAndTest(result, ITEM, 3.5, [5, 2], [vc1, vc2])
+        getAndTest(result, 'entity7', 2, [2], [makeVC('c0', 1)])
+        put(ITEM, 4, vc3)
+        settle()
+        again = snapshot.Importer(serverconfigs[0], SNAPSHOT_BATCH).run(snapshot.read(StringIO.StringIO(out.getvalue())))
+        result({ 'type': 'EXPECT_STALE', 'format': format, 'got': again['stale'], 'expected': SNAPSHOT_ENTITIES+2 })
+        settle()
+        getAndTest(result, ITEM, 3, [2, 4], [vc2, vc3])
+    # Records a PUT could not have stored are counted and left out
+    lines = [ '{"key": "/rating/%s", "choices": %s, "clocks": %s}' % (entity(id), choices, clocks) for id, choices, clocks in [
+        ('snap-nan', '[NaN]', '[{"c0": 1}]'), ('snap-inf', '[Infinity]', '[{"c0": 1}]'),
+        ('snap-huge', '[1.7e308, 1.7e308]', '[{"c0": 1}, {"c1": 1}]'), ('snap-counter', '[3]', '[{"c0": 9007199254740993}]'),
+        ('snap-ok', '[3]', '[{"c0": 1}]') ] ]
+    imported = snapshot.Importer(serverconfigs[0], SNAPSHOT_BATCH).run(snapshot.read(StringIO.StringIO('\n'.join(lines)+'\n')))
+    result({ 'type': 'EXPECT_IMPORTED', 'got': (imported['records'], imported['invalid']), 'expected': [ 1, 4 ] })
+    settle()
+    getAndTest(result, 'snap-ok', 3, [3], [makeVC('c0', 1)])
+    ratings = [ requests.get(endpoint+'/rating/'+entity(id), headers={ 'Accept': 'application/json' }).json()['rating'] for id in ('snap-nan', 'snap-inf', 'snap-huge', 'snap-counter') ]
+    result({ 'type': 'EXPECT_EMPTY', 'got': ratings, 'expected': [ None ] * 4 })
+
+# Go through all the tests and run them, or the benchmark
 try:
-    for test in tests:
-        if args.test == None or args.test == test.__name__:
-            test()
+    if args.bench:
+        benchmark()
+    else:
+        chosen = [ test for test in tests if args.test == None or args.test == test.__name__ ]
+        pool = ThreadPool(args.jobs)
+        try:
+            pool.map(lambda test: test(), [ test for test in chosen if not test.exclusive ])
+        finally:
+            pool.close()
+        for test in chosen:
+            if test.exclusive:
+                test()
 finally:
     # Shut. down. everything.
-    server.terminate()
+    for server in servers: server.terminate()
+    # Let a buffering server write out what it holds before Redis goes away
+    for server in servers: server.wait()
     if not args.leavedb:
         for p in processes: p.terminate()
 
@@ -9,7 +9,21 @@
     License: Version 2 of GPL: http://www.gnu.org/licenses/old-licenses/gpl-2.0.html
 '''
 
+import bisect
 import copy
+from array import array
+from itertools import izip
+
+try:
+    import numpy
+except ImportError:  # only needed for ClockMatrix
+    numpy = None
+
+# Results of VectorClock.compare
+BEFORE = 'before'
+AFTER = 'after'
+EQUAL = 'equal'
+CONCURRENT = 'concurrent'
 
 # PART coreclass
 class VectorClock(object):
@@ -55,30 +69,51 @@ class VectorClock(object):
 
 # PART comparisons
     # Comparison operations. Vector clocks are partially ordered, but not totally ordered.
+    def compare(self, other):
+        """Return BEFORE, AFTER, EQUAL or CONCURRENT for this clock relative to
+        other, in a single pass over the union of their nodes."""
+        theirs = other.clock
+        less = greater = False
+        shared = 0
+        for node, count in self.clock.iteritems():
+            other_count = theirs.get(node)
+            if other_count is None:
+                greater = True
+            else:
+                shared += 1
+                if count > other_count:
+                    greater = True
+                elif count < other_count:
+                    less = True
+                else:
+                    continue
+            if less and greater:
+                return CONCURRENT
+        if shared < len(theirs):  # other has nodes this clock lacks
+            if greater:
+                return CONCURRENT
+            less = True
+        if less:
+            return BEFORE
+        return AFTER if greater else EQUAL
+
     def __eq__(self, other):
         return self.clock == other.clock
 
     def __lt__(self, other):
-        if self == other:
-            return False
-        for node in self.clock:
-            if node not in other.clock:
-                return False
-            elif self.clock[node] > other.clock[node]:
-                return False
-        return True
+        return self.compare(other) is BEFORE
 
     def __ne__(self, other):
         return not (self == other)
 
     def __le__(self, other):
-        return (self == other) or (self < other)
+        return self.compare(other) in (BEFORE, EQUAL)
 
     def __gt__(self, other):
-        return (other < self)
+        return self.compare(other) is AFTER
 
     def __ge__(self, other):
-        return (self == other) or (self > other)
+        return self.compare(other) in (AFTER, EQUAL)
 
 # PART coalesce
 # CAUTION--HAS BUG AND IS MORE COMPLEX THAN NEEDED FOR THIS ASSIGNMENT
@@ -94,10 +129,11 @@ class VectorClock(object):
             # See if this vector-clock subsumes or is subsumed by anything already present
             subsumed = False
             for ii, result in enumerate(results):
-                if vc <= result:  # subsumed by existing answer
+                order = vc.compare(result)
+                if order is BEFORE or order is EQUAL:  # subsumed by existing answer
                     subsumed = True
                     break
-                if result < vc:  # subsumes existing answer so replace it
+                if order is AFTER:  # subsumes existing answer so replace it
                     results[ii] = copy.deepcopy(vc)
                     subsumed = True
                     break
@@ -117,15 +153,16 @@ class VectorClock(object):
         results = []
         for obj, vc in vcs:
             if vc is None:  # Treat None as empty VectorClock
-                vc = VectorClock()
+                vc = cls()
             # See if this vector-clock subsumes or is subsumed by anything already present
             subsumed = False
             for ii, (resultobj, resultvc) in enumerate(results):
-                if vc <= resultvc:  # subsumed by existing answer
+                order = vc.compare(resultvc)
+                if order is BEFORE or order is EQUAL:  # subsumed by existing answer
                     subsumed = True
                     break
 
-                if resultvc < vc:  # subsumes existing answer so replace it
+                if order is AFTER:  # subsumes existing answer so replace it
                     results[ii] = (obj, copy.deepcopy(vc))
                     subsumed = True
                     break
@@ -149,17 +186,413 @@ class VectorClock(object):
                     result.clock[node] = counter
         return result
 
+# PART clockset
+class ClockSet(object):
+    """An antichain of (value, VectorClock) pairs: no clock in the set is
+    before or equal to another. Pairs are kept oldest first.
+
+    The set also keeps the highest counter of every node across its clocks,
+    which settles the common cases without comparing against every member:
+    a clock at or above all of them supersedes the whole set, and a clock
+    with any node above them cannot be stale."""
+
+    def __init__(self, cls=VectorClock):
+        self.cls = cls
+        self.values = []
+        self.clocks = []
+        self.top = {}  # node => highest counter in any clock
+
+    @classmethod
+    def fromLists(cls, values, clocks, vcclass=VectorClock):
+        """Build a set from parallel lists of values and clock dictionaries,
+        which must already form an antichain."""
+        result = cls(vcclass)
+        result.values = list(values)
+        result.clocks = [vcclass.fromDict(clock) for clock in clocks]
+        for vc in result.clocks:
+            result._raise(vc.asDict())
+        return result
+
+    def asLists(self):
+        """Return (values, clock dictionaries) as parallel lists."""
+        return list(self.values), [dict(vc.asDict()) for vc in self.clocks]
+
+    def copy(self):
+        result = ClockSet(self.cls)
+        result.values, result.clocks, result.top = list(self.values), list(self.clocks), dict(self.top)
+        return result
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(zip(self.values, self.clocks))
+
+    def _raise(self, clock):
+        top = self.top
+        for node, counter in clock.iteritems():
+            if top.get(node, -1) < counter:
+                top[node] = counter
+
+    def insert(self, value, vc):
+        """Add a pair in one pass over the set, dropping every member its
+        clock supersedes. Returns the values dropped, or None (leaving the
+        set unchanged) if the clock is before or equal to a member's."""
+        clock, top = vc.asDict(), self.top
+        if all(clock.get(node, -1) >= counter for node, counter in top.iteritems()):
+            # At or above every member; only stale if it equals one of them
+            if clock == top and any(member.asDict() == clock for member in self.clocks):
+                return None
+            dropped = self.values
+            self.values, self.clocks, self.top = [value], [vc], dict(clock)
+            return dropped
+        # A clock with a node above every member's cannot be before or equal
+        # to any of them, so it only needs checking for members to drop
+        covered = all(top.get(node, -1) >= counter for node, counter in clock.iteritems())
+        values, clocks, dropped = [], [], []
+        for member, other in zip(self.values, self.clocks):
+            order = vc.compare(other)
+            if order is AFTER:
+                dropped.append(member)
+                continue
+            if covered and (order is BEFORE or order is EQUAL):
+                return None
+            values.append(member)
+            clocks.append(other)
+        values.append(value)
+        clocks.append(vc)
+        self.values, self.clocks = values, clocks
+        # Dropped members were below vc on every node, so this stays exact
+        self._raise(clock)
+        return dropped
+
+    def merge(self, other):
+        """Merge every pair of another ClockSet into this one, in order. As
+        the other set is an antichain too, its pairs are only compared with
+        this set's own members, never with each other. Returns the values
+        dropped from this set."""
+        mine = len(self.clocks)
+        keep = [True] * mine
+        added = []
+        for value, vc in other:
+            clock = vc.asDict()
+            covered = all(self.top.get(node, -1) >= counter for node, counter in clock.iteritems())
+            stale = False
+            for ii in xrange(mine):
+                if not keep[ii]:
+                    continue
+                order = vc.compare(self.clocks[ii])
+                if order is AFTER:
+                    keep[ii] = False
+                elif covered and (order is BEFORE or order is EQUAL):
+                    stale = True
+                    break
+            if not stale:
+                added.append((value, vc))
+        dropped = [value for value, kept in zip(self.values, keep) if not kept]
+        self.values = [value for value, kept in zip(self.values, keep) if kept]
+        self.clocks = [vc for vc, kept in zip(self.clocks, keep) if kept]
+        for value, vc in added:
+            self.values.append(value)
+            self.clocks.append(vc)
+            self._raise(vc.asDict())
+        return dropped
+
+# PART compact
+class NodeTable(object):
+    """Intern table mapping node names to small integers, shared by every
+    CompactVectorClock so that each clock only stores the integers."""
+
+    def __init__(self):
+        self.ids = {}    # node => id
+        self.names = []  # id => node
+
+    def intern(self, node):
+        """Return the id of a node, assigning the next free one if it is new."""
+        nid = self.ids.get(node)
+        if nid is None:
+            nid = self.ids[node] = len(self.names)
+            self.names.append(node)
+        return nid
+
+NODES = NodeTable()
+
+
+class CompactVectorClock(object):
+    """Drop-in alternative to VectorClock for large numbers of clocks.
+
+    Node names are interned in NODES and each clock keeps its entries in two
+    parallel arrays sorted by node id, so a clock costs a few bytes per entry
+    instead of a dictionary, and comparisons walk integers instead of hashing
+    strings. Counters must fit in a signed 32-bit integer."""
+    __slots__ = ('ids', 'counts')
+
+    def __init__(self):
+        self.ids = array('i')     # sorted node ids
+        self.counts = array('i')  # counter of each node in ids
+
+    def update(self, node, counter):
+        """Add a new node:counter value to a CompactVectorClock."""
+        if counter < 0:
+            raise Exception("Node %s assigned negative count %d" % (node, counter))
+        nid = NODES.intern(node)
+        ii = bisect.bisect_left(self.ids, nid)
+        if ii < len(self.ids) and self.ids[ii] == nid:
+            if counter <= self.counts[ii]:
+                raise Exception("Node %s has gone backwards from %d to %d" %
+                                (node, self.counts[ii], counter))
+            self.counts[ii] = counter
+        else:
+            self.ids.insert(ii, nid)
+            self.counts.insert(ii, counter)
+        return self  # allow chaining of .update() operations
+
+    @classmethod
+    def fromDict(cls, dct):
+        """ Create a CompactVectorClock from a dictionary. """
+        entries = []
+        for node, count in dct.iteritems():
+            if count < 0:
+                raise Exception("Node %s assigned negative count %d" % (node, count))
+            entries.append((NODES.intern(node), count))
+        entries.sort()
+        vc = cls()
+        vc.ids.extend(nid for nid, _ in entries)
+        vc.counts.extend(count for _, count in entries)
+        return vc
+
+    def asDict(self):
+        names = NODES.names
+        return dict((names[nid], count) for nid, count in izip(self.ids, self.counts))
+
+    # Read-only view for code written against VectorClock.clock
+    clock = property(asDict)
+
+    def isValidClock(self):
+        """ Return True if this is a valid clock. """
+        for nid in self.ids:
+            if not isinstance(NODES.names[nid], (str, unicode)):
+                return False
+        return True
+
+    def __str__(self):
+        return "{%s}" % ", ".join(["%s:%d" % entry for entry in sorted(self.asDict().items())])
+
+    def __repr__(self):
+        """ Represent the clock in JSON style, with the keys in double quotes. """
+        return "{%s}" % ", ".join(["\"%s\":%d" % entry for entry in sorted(self.asDict().items())])
+
+    def compare(self, other):
+        """Return BEFORE, AFTER, EQUAL or CONCURRENT for this clock relative to
+        other, stopping as soon as the clocks are known to be concurrent.
+        Clocks over as many nodes are either over the same ones, and compare
+        counters pairwise, or concurrent; others walk the two sorted id
+        arrays together."""
+        ids, counts, theirs, their_counts = self.ids, self.counts, other.ids, other.counts
+        n, m = len(ids), len(theirs)
+        if n == m:
+            if ids.tostring() != theirs.tostring():
+                # As many nodes but not the same ones: each clock has a node
+                # the other lacks
+                return CONCURRENT
+            less = greater = False
+            for count, other_count in izip(counts, their_counts):
+                if count > other_count:
+                    if less:
+                        return CONCURRENT
+                    greater = True
+                elif count < other_count:
+                    if greater:
+                        return CONCURRENT
+                    less = True
+            if less:
+                return BEFORE
+            return AFTER if greater else EQUAL
+        less = greater = False
+        ii = jj = 0
+        while ii < n and jj < m:
+            nid, other_nid = ids[ii], theirs[jj]
+            if nid == other_nid:
+                count, other_count = counts[ii], their_counts[jj]
+                ii += 1
+                jj += 1
+                if count > other_count:
+                    greater = True
+                elif count < other_count:
+                    less = True
+                else:
+                    continue
+            elif nid < other_nid:  # other lacks this node
+                greater = True
+                ii += 1
+            else:  # this clock lacks other's node
+                less = True
+                jj += 1
+            if less and greater:
+                return CONCURRENT
+        if ii < n:
+            greater = True
+        if jj < m:
+            less = True
+        if less:
+            return CONCURRENT if greater else BEFORE
+        return AFTER if greater else EQUAL
+
+    def __eq__(self, other):
+        # Compare the raw buffers; array's own == boxes every element
+        return (self.ids.tostring() == other.ids.tostring() and
+                self.counts.tostring() == other.counts.tostring())
+
+    def __lt__(self, other):
+        return self.compare(other) is BEFORE
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __le__(self, other):
+        return self.compare(other) in (BEFORE, EQUAL)
+
+    def __gt__(self, other):
+        return self.compare(other) is AFTER
+
+    def __ge__(self, other):
+        return self.compare(other) in (AFTER, EQUAL)
+
+    # coalesce and coalesce2 only rely on compare()
+    coalesce = classmethod(VectorClock.coalesce.im_func)
+    coalesce2 = classmethod(VectorClock.coalesce2.im_func)
+
+    @classmethod
+    def converge(cls, vcs):
+        """Return a single CompactVectorClock that subsumes all of the input clocks"""
+        merged = {}
+        for vc in vcs:
+            if vc is None:
+                continue
+            for nid, counter in izip(vc.ids, vc.counts):
+                if merged.get(nid, -1) < counter:
+                    merged[nid] = counter
+        result = cls()
+        for nid in sorted(merged):
+            result.ids.append(nid)
+            result.counts.append(merged[nid])
+        return result
+
+# PART batch
+class ClockMatrix(object):
+    """A sibling set held as a dense (siblings x nodes) integer matrix.
+
+    Row ii is the clock of sibling ii and column jj the counter of node
+    nodes[jj]; -1 marks a node the clock does not have, which compares below
+    any counter just as a missing node does in compare(). values holds an
+    optional object per sibling, as in coalesce2. Comparing one clock against
+    every sibling is a handful of vectorized numpy operations, which beats a
+    loop over compare() once there are dozens of siblings or nodes."""
+
+    def __init__(self, nodes, rows, values=None):
+        if numpy is None:
+            raise ImportError("ClockMatrix requires numpy")
+        self.nodes = nodes  # column => node
+        self.index = dict((node, jj) for jj, node in enumerate(nodes))
+        self.rows = rows
+        self.values = values if values is not None else [None] * len(rows)
+
+    @classmethod
+    def fromClocks(cls, vcs, values=None):
+        """Build a ClockMatrix from VectorClocks of either representation."""
+        if numpy is None:
+            raise ImportError("ClockMatrix requires numpy")
+        dcts = [vc.asDict() for vc in vcs]
+        nodes = sorted(set(node for dct in dcts for node in dct))
+        index = dict((node, jj) for jj, node in enumerate(nodes))
+        rows = numpy.full((len(dcts), len(nodes)), -1, dtype=numpy.int64)
+        ii = [ii for ii, dct in enumerate(dcts) for _ in dct]
+        jj = [index[node] for dct in dcts for node in dct]
+        rows[ii, jj] = [counter for dct in dcts for counter in dct.itervalues()]
+        return cls(nodes, rows, list(values) if values is not None else None)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def clocks(self, cls=VectorClock):
+        """Return the siblings as a list of clocks of class cls."""
+        return [cls.fromDict(dict((self.nodes[jj], int(row[jj]))
+                                  for jj in numpy.flatnonzero(row >= 0)))
+                for row in self.rows]
+
+    def _align(self, vc):
+        """Return vc as a row over self.nodes, and the nodes of vc that are
+        not columns of this matrix."""
+        vector = numpy.full(len(self.nodes), -1, dtype=numpy.int64)
+        extra = {}
+        for node, counter in vc.asDict().iteritems():
+            jj = self.index.get(node)
+            if jj is None:
+                extra[node] = counter
+            else:
+                vector[jj] = counter
+        return vector, extra
+
+    def dominance(self, vc):
+        """Compare vc against every sibling in one vectorized step.
+
+        Returns three boolean arrays over the siblings: those vc dominates,
+        those that dominate or equal vc (so vc is stale), and those
+        concurrent with vc."""
+        vector, extra = self._align(vc)
+        below = (self.rows <= vector).all(axis=1)  # sibling <= vc
+        above = (self.rows >= vector).all(axis=1)  # sibling >= vc
+        if extra:  # vc is ahead of every sibling on these nodes
+            above[:] = False
+        return below & ~above, above, ~(below | above)
+
+    def merge(self, vc, value=None):
+        """Batch form of the put_rating merge: return a new ClockMatrix with
+        the siblings vc dominates replaced by (value, vc), or None if vc is
+        dominated by or equal to a sibling."""
+        dominated, dominating, concurrent = self.dominance(vc)
+        if dominating.any():
+            return None
+        vector, extra = self._align(vc)
+        keep = numpy.flatnonzero(concurrent)
+        rows = self.rows[keep]
+        if extra:
+            rows = numpy.hstack((rows, numpy.full((len(rows), len(extra)), -1, dtype=numpy.int64)))
+            vector = numpy.concatenate((vector, extra.values()))
+        rows = numpy.vstack((rows, vector))
+        values = [self.values[ii] for ii in keep] + [value]
+        return ClockMatrix(self.nodes + extra.keys(), rows, values)
+
+    def coalesced(self):
+        """Batch form of coalesce2: return a new ClockMatrix without the
+        siblings dominated by another, keeping the first of equal clocks."""
+        le = (self.rows[:, None, :] <= self.rows[None, :, :]).all(axis=2)  # ii <= jj
+        equal = le & le.T
+        dominated = (le & ~equal).any(axis=1)
+        duplicate = numpy.triu(equal, 1).any(axis=0)  # equal to an earlier sibling
+        keep = numpy.flatnonzero(~(dominated | duplicate))
+        return ClockMatrix(self.nodes, self.rows[keep], [self.values[ii] for ii in keep])
+
+    def converge(self, cls=VectorClock):
+        """Batch form of converge: a single clock that subsumes every sibling."""
+        if not len(self.rows):
+            return cls()
+        top = self.rows.max(axis=0)
+        return cls.fromDict(dict((node, int(counter))
+                                 for node, counter in izip(self.nodes, top) if counter >= 0))
+
 # -----------IGNOREBEYOND: test code ---------------
 import unittest
 
 
 class VectorClockTestCase(unittest.TestCase):
     """Test vector clock class"""
+    cls = VectorClock
 
     def setUp(self):
-        self.c1 = VectorClock()
+        self.c1 = self.cls()
         self.c1.update('A', 1)
-        self.c2 = VectorClock()
+        self.c2 = self.cls()
         self.c2.update('B', 2)
 
     def testSmall(self):
@@ -197,17 +630,31 @@ class VectorClockTestCase(unittest.TestCase):
         self.assertEquals(self.c1 >= self.c2, True)
         self.assertEquals(self.c2 >= self.c1, False)
 
+    def testCompare(self):
+        self.assertEquals(self.c1.compare(self.c2), CONCURRENT)
+        self.assertEquals(self.c1.compare(self.c1), EQUAL)
+        self.c1.update('B', 2)
+        self.assertEquals(self.c1.compare(self.c2), AFTER)
+        self.assertEquals(self.c2.compare(self.c1), BEFORE)
+        self.c2.update('B', 3)
+        self.assertEquals(self.c1.compare(self.c2), CONCURRENT)
+        self.c2.update('A', 1)
+        self.assertEquals(self.c1.compare(self.c2), BEFORE)
+        self.assertEquals(self.c2.compare(self.c1), AFTER)
+        self.assertEquals(self.cls().compare(self.cls()), EQUAL)
+        self.assertEquals(self.cls().compare(self.c1), BEFORE)
+
     def testCoalesce(self):
         self.c1.update('B', 2)
-        self.assertEquals(VectorClock.coalesce((self.c1, self.c1, self.c1)), [self.c1])
+        self.assertEquals(self.cls.coalesce((self.c1, self.c1, self.c1)), [self.c1])
         c3 = copy.deepcopy(self.c1)
         c4 = copy.deepcopy(self.c1)
         # Diverge the two clocks
         c3.update('X', 200)
         c4.update('Y', 100)
         # c1 < c3, c1 < c4
-        self.assertEquals(VectorClock.coalesce(((self.c1, c3, c4))), [c3, c4])
-        self.assertEquals(VectorClock.coalesce((c3, self.c1, c3, c4)), [c3, c4])
+        self.assertEquals(self.cls.coalesce(((self.c1, c3, c4))), [c3, c4])
+        self.assertEquals(self.cls.coalesce((c3, self.c1, c3, c4)), [c3, c4])
 
     def testConverge(self):
         self.c1.update('B', 1)
@@ -216,11 +663,129 @@ class VectorClockTestCase(unittest.TestCase):
         # Diverge two of the clocks
         c3.update('X', 200)
         self.c1.update('Y', 100)
-        cx = VectorClock.converge((self.c1, self.c2, c3, c4))
+        cx = self.cls.converge((self.c1, self.c2, c3, c4))
         self.assertEquals(str(cx), "{A:1, B:2, X:200, Y:100}")
-        cy = VectorClock.converge(VectorClock.coalesce((self.c1, self.c2, c3, c4)))
+        cy = self.cls.converge(self.cls.coalesce((self.c1, self.c2, c3, c4)))
         self.assertEquals(str(cy), "{A:1, B:2, X:200, Y:100}")
 
 
+class CompactVectorClockTestCase(VectorClockTestCase):
+    """Run the vector clock tests against the compact representation"""
+    cls = CompactVectorClock
+
+    def testDict(self):
+        dct = {'A': 3, 'B': 2, 'Z': 7}
+        vc = CompactVectorClock.fromDict(dct)
+        self.assertEquals(vc.asDict(), dct)
+        self.assertEquals(vc, CompactVectorClock().update('Z', 7).update('A', 3).update('B', 2))
+        self.assertEquals(vc.asDict(), VectorClock.fromDict(dct).asDict())
+        self.assertRaises(Exception, CompactVectorClock.fromDict, {'A': -1})
+
+    def testCompareAgrees(self):
+        import random
+        rng = random.Random(0)
+        for _ in range(2000):
+            dcts = [dict((node, rng.randint(1, 3)) for node in rng.sample('ABCD', rng.randint(0, 4)))
+                    for _ in range(2)]
+            self.assertEquals(CompactVectorClock.fromDict(dcts[0]).compare(CompactVectorClock.fromDict(dcts[1])),
+                              VectorClock.fromDict(dcts[0]).compare(VectorClock.fromDict(dcts[1])))
+
+    def testSize(self):
+        import sys
+        dct = dict(('c%d' % ii, ii) for ii in range(10))
+        dictsize = lambda vc: sys.getsizeof(vc) + sys.getsizeof(vc.__dict__) + sys.getsizeof(vc.clock)
+        compactsize = lambda vc: sys.getsizeof(vc) + sys.getsizeof(vc.ids) + sys.getsizeof(vc.counts)
+        self.assertTrue(compactsize(CompactVectorClock.fromDict(dct)) < dictsize(VectorClock.fromDict(dct)) / 2)
+
+
+
+class ClockSetTestCase(unittest.TestCase):
+    """Test the antichain of sibling clocks against pairwise comparison"""
+
+    def setUp(self):
+        self.siblings = ClockSet.fromLists([5, 2], [{'A': 2}, {'B': 3}])
+
+    def naive(self, pairs, value, vc):
+        if any(vc.compare(other) in (BEFORE, EQUAL) for _, other in pairs):
+            return None
+        return [(v, other) for v, other in pairs if vc.compare(other) is not AFTER] + [(value, vc)]
+
+    def testInsert(self):
+        self.assertEquals(self.siblings.insert(1, VectorClock.fromDict({'A': 1})), None)
+        self.assertEquals(self.siblings.insert(1, VectorClock.fromDict({'B': 3})), None)
+        self.assertEquals(self.siblings.insert(3, VectorClock.fromDict({'A': 3})), [5])
+        self.assertEquals(self.siblings.asLists(), ([2, 3], [{'B': 3}, {'A': 3}]))
+        self.assertEquals(self.siblings.insert(4, VectorClock.fromDict({'A': 3, 'B': 3})), [2, 3])
+        self.assertEquals(self.siblings.insert(4, VectorClock.fromDict({'A': 3, 'B': 3})), None)
+        self.assertEquals(self.siblings.top, {'A': 3, 'B': 3})
+        self.assertEquals(len(ClockSet()), 0)
+
+    def testMerge(self):
+        other = ClockSet.fromLists([1, 3, 4], [{'A': 1}, {'A': 3}, {'C': 1}])
+        self.assertEquals(self.siblings.merge(other), [5])
+        self.assertEquals(self.siblings.asLists(), ([2, 3, 4], [{'B': 3}, {'A': 3}, {'C': 1}]))
+
+    def testRandom(self):
+        import random
+        rng = random.Random(18)
+        def build():
+            siblings, pairs = ClockSet(), []
+            for value in range(12):
+                vc = VectorClock.fromDict(dict((node, rng.randint(0, 3)) for node in rng.sample('ABCD', rng.randint(0, 3))))
+                expected = self.naive(pairs, value, vc)
+                self.assertEquals(siblings.insert(value, vc) is None, expected is None)
+                pairs = expected or pairs
+                self.assertEquals(list(siblings), pairs)
+            return siblings
+        for trial in range(200):
+            siblings, other = build(), build()
+            expected = list(siblings)
+            for value, vc in other:
+                expected = self.naive(expected, value, vc) or expected
+            siblings.merge(other)
+            self.assertEquals(list(siblings), expected)
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class ClockMatrixTestCase(unittest.TestCase):
+    """Test the vectorized sibling set against the scalar operations"""
+
+    def setUp(self):
+        self.vcs = [VectorClock.fromDict(dct) for dct in
+                    ({'A': 2}, {'B': 3}, {'A': 1, 'C': 4}, {'B': 1, 'C': 1})]
+        self.matrix = ClockMatrix.fromClocks(self.vcs, values=[5, 2, 3, 1])
+
+    def testClocks(self):
+        self.assertEquals(self.matrix.clocks(), self.vcs)
+        self.assertEquals(self.matrix.clocks(CompactVectorClock)[2],
+                          CompactVectorClock.fromDict({'A': 1, 'C': 4}))
+
+    def testDominance(self):
+        for dct in ({'A': 2, 'C': 4}, {'B': 3}, {'B': 2}, {'D': 1}, {'A': 3, 'B': 3, 'C': 5}, {}):
+            vc = VectorClock.fromDict(dct)
+            dominated, dominating, concurrent = self.matrix.dominance(vc)
+            orders = [other.compare(vc) for other in self.vcs]
+            self.assertEquals(list(dominated), [order is BEFORE for order in orders])
+            self.assertEquals(list(dominating), [order in (AFTER, EQUAL) for order in orders])
+            self.assertEquals(list(concurrent), [order is CONCURRENT for order in orders])
+
+    def testMerge(self):
+        self.assertEquals(self.matrix.merge(VectorClock.fromDict({'B': 2})), None)
+        merged = self.matrix.merge(VectorClock.fromDict({'A': 2, 'C': 4, 'D': 1}), 7)
+        self.assertEquals(merged.values, [2, 1, 7])
+        self.assertEquals(merged.clocks()[2], VectorClock.fromDict({'A': 2, 'C': 4, 'D': 1}))
+        self.assertEquals(merged.merge(VectorClock.fromDict({'D': 1}), 8), None)
+
+    def testCoalesce(self):
+        vcs = self.vcs + [VectorClock.fromDict({'A': 2, 'C': 4}), VectorClock.fromDict({'B': 3})]
+        coalesced = ClockMatrix.fromClocks(vcs, values=range(6)).coalesced()
+        self.assertEquals(coalesced.clocks(), [vcs[1], vcs[3], vcs[4]])
+        self.assertEquals(coalesced.values, [1, 3, 4])
+
+    def testConverge(self):
+        self.assertEquals(self.matrix.converge(), VectorClock.converge(self.vcs))
+        self.assertEquals(ClockMatrix.fromClocks([]).converge(), VectorClock())
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+'''
+	Write-behind buffer for hot entities
+
+	Incoming (rating, clock) pairs are merged in memory per entity, into a
+	ClockSet, with the same dominance rules merge.lua applies, and each
+	entity's merged sibling set is written out at most once per flush. A flush happens every
+	interval seconds, as soon as an entity collects size siblings, or when
+	more than limit siblings are buffered in total. A sibling set that fails
+	to be written goes back into the buffer and is tried again with the next
+	flush, up to retries times; then it is dropped and counted.
+'''
+
+import threading
+
+from vectorclock import VectorClock, ClockSet, BEFORE, AFTER, EQUAL
+
+def merge(choices, clocks, rating, clock, aggregates=None):
+	"""Merge one (rating, clock) pair into parallel lists of choices and clock
+	dictionaries, exactly as merge.lua does; the new pair goes last, so the
+	siblings stay oldest first. Returns the new lists, or None if the pair
+	is dominated by or equal to an existing sibling. If given, aggregates
+	are adjusted for the siblings added and dominated."""
+	incoming = VectorClock.fromDict(clock)
+	new_choices, new_clocks, dropped = [], [], []
+	for choice, other in zip(choices, clocks):
+		order = incoming.compare(VectorClock.fromDict(other))
+		if order is BEFORE or order is EQUAL:
+			return None
+		elif order is AFTER:
+			dropped.append(choice)
+		else:
+			new_choices.append(choice)
+			new_clocks.append(other)
+	new_choices.append(rating)
+	new_clocks.append(clock)
+	if aggregates is not None:
+		aggregates.add(rating)
+		for choice in dropped:
+			aggregates.remove(choice, new_choices)
+	return new_choices, new_clocks
+
+def fold(choices, clocks, limit, aggregates=None):
+	"""Fold the oldest siblings into one so that at most limit are left, as
+	merge.lua does under the 'fold' policy: the new sibling has the converged
+	clock and the mean rating of those folded, and goes first. Survivors it
+	dominates are dropped. Returns the new lists, adjusting aggregates if
+	given."""
+	if len(choices) <= limit:
+		return choices, clocks
+	n = len(choices) - limit + 1
+	rating = sum(choices[:n])/n
+	folded = VectorClock.converge(VectorClock.fromDict(other) for other in clocks[:n])
+	new_choices, new_clocks, removed = [rating], [folded.asDict()], choices[:n]
+	for choice, other in zip(choices[n:], clocks[n:]):
+		if folded.compare(VectorClock.fromDict(other)) is AFTER:
+			removed.append(choice)
+		else:
+			new_choices.append(choice)
+			new_clocks.append(other)
+	if aggregates is not None:
+		aggregates.add(rating)
+		for choice in removed:
+			aggregates.remove(choice, new_choices)
+	return new_choices, new_clocks
+
+class WriteBuffer(object):
+	def __init__(self, write, interval=0.05, size=32, limit=10000, retries=3):
+		# write(batch) stores a list of (key, choices, clocks) sibling sets;
+		# it may return a list with an exception in place of each set it
+		# failed to store, or raise if it stored none
+		self.write = write
+		self.interval = interval
+		self.size = size
+		self.limit = limit
+		self.retries = retries
+		self.pending = { }   # key => ClockSet
+		self.buffered = 0    # siblings across all of pending
+		self.flushing = [ ]  # batches taken out of pending but not yet written
+		self.failed = { }    # key => flushes of it that failed in a row
+		self.lock = threading.Lock()
+		self.drained = threading.Condition(self.lock)  # notified as batches finish
+		self.stopped = threading.Event()
+		self.thread = None
+		self.stats = { 'writes': 0, 'stale': 0, 'flushes': 0, 'flushed': 0, 'failures': 0, 'dropped': 0 }
+
+	def put(self, key, rating, clock):
+		"""Buffer a rating; clock is a dictionary of node => counter. Returns
+		the mean of the siblings buffered for key."""
+		with self.lock:
+			self.stats['writes'] += 1
+			siblings = self.pending.get(key) or ClockSet()
+			before = len(siblings)
+			if siblings.insert(rating, VectorClock.fromDict(clock)) is None:
+				self.stats['stale'] += 1
+			else:
+				self.pending[key] = siblings
+				self.buffered += len(siblings) - before
+			choices = list(siblings.values)
+			full = len(choices) >= self.size or self.buffered > self.limit
+		if full:
+			self.flush()
+		return sum(choices)/len(choices)
+
+	def get(self, key):
+		"""Return the buffered (choices, clocks) for key, including any being
+		flushed right now, or None."""
+		with self.lock:
+			sets = [ batch[key] for batch in self.flushing if key in batch ]
+			if key in self.pending:
+				sets.append(self.pending[key])
+		if not sets:
+			return None
+		siblings = sets[0].copy()
+		for later in sets[1:]:
+			siblings.merge(later)
+		return siblings.asLists()
+
+	def discard(self, key):
+		"""Drop anything buffered for key; True if there was something. A
+		batch holding key that is being written is waited for first, so that
+		it cannot land after the caller deletes the stored record."""
+		with self.lock:
+			flushed = False
+			while any(key in batch for batch in self.flushing):
+				flushed = True
+				self.drained.wait()
+			dropped = self.pending.pop(key, None)
+			if dropped:
+				self.buffered -= len(dropped)
+			self.failed.pop(key, None)
+			return flushed or dropped is not None
+
+	def flush(self):
+		"""Write every buffered sibling set out in one batch; returns whether
+		all of it was written. A set that was not goes back into pending,
+		merged with whatever was buffered for its key since, which stays
+		newest; after retries failures in a row it is dropped instead."""
+		with self.lock:
+			pending, self.pending, self.buffered = self.pending, { }, 0
+			if not pending:
+				return True
+			self.flushing.append(pending)
+			batch = [ (key,) + siblings.asLists() for key, siblings in pending.iteritems() ]
+		try:
+			outcomes = self.write(batch) or [ None ] * len(batch)
+		except Exception as e:
+			outcomes = [ e ] * len(batch)
+		with self.lock:
+			self.flushing.remove(pending)
+			failed = set(key for (key, _, _), outcome in zip(batch, outcomes) if isinstance(outcome, Exception))
+			if len(failed) < len(batch):
+				self.stats['flushes'] += 1
+				self.stats['flushed'] += len(batch) - len(failed)
+			self.stats['failures'] += len(failed)
+			for key in pending:
+				if key not in failed:
+					self.failed.pop(key, None)
+			for key in failed:
+				siblings, newer = pending[key], self.pending.get(key)
+				if newer:
+					siblings.merge(newer)
+					self.buffered -= len(newer)
+				self.failed[key] = self.failed.get(key, 0) + 1
+				if self.failed[key] > self.retries:
+					# Keeps failing; holding it would only hold up the rest
+					del self.failed[key]
+					self.pending.pop(key, None)
+					self.stats['dropped'] += len(siblings)
+					continue
+				self.pending[key] = siblings
+				self.buffered += len(siblings)
+			self.drained.notify_all()
+		return not failed
+
+	def start(self):
+		"""Flush every interval seconds from a background thread."""
+		def loop():
+			while not self.stopped.wait(self.interval):
+				self.flush()
+		self.thread = threading.Thread(target=loop)
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		"""Stop the background thread and flush whatever is left."""
+		self.stopped.set()
+		if self.thread:
+			self.thread.join()
+		self.flush()
+
+# -----------IGNOREBEYOND: test code ---------------
+import time
+import unittest
+from aggregates import Aggregates
+
+
+class WriteBufferTestCase(unittest.TestCase):
+	"""Test write coalescing"""
+
+	def setUp(self):
+		self.batches = [ ]
+		self.buffer = WriteBuffer(self.batches.append, size=3, limit=4)
+
+	def testMerge(self):
+		self.assertEquals(merge([5.0], [{ 'c0': 5 }], 2.0, { 'c0': 1 }), None)
+		self.assertEquals(merge([5.0], [{ 'c0': 5 }], 5.0, { 'c0': 5 }), None)
+		self.assertEquals(merge([5.0], [{ 'c0': 5 }], 2.0, { 'c1': 3 }), ([5.0, 2.0], [{ 'c0': 5 }, { 'c1': 3 }]))
+		self.assertEquals(merge([5.0, 2.0], [{ 'c0': 5 }, { 'c1': 3 }], 3.0, { 'c0': 7, 'c1': 10 }),
+		                  ([3.0], [{ 'c0': 7, 'c1': 10 }]))
+
+	def testFold(self):
+		choices, clocks = [5.0, 2.0, 4.0, 1.0], [{ 'c0': 2 }, { 'c1': 2 }, { 'c0': 1, 'c1': 1 }, { 'c2': 1 }]
+		aggregates = Aggregates.fromChoices(choices)
+		self.assertEquals(fold(choices, clocks, 4), (choices, clocks))
+		self.assertEquals(fold(choices, clocks, 3, aggregates), ([3.5, 1.0], [{ 'c0': 2, 'c1': 2 }, { 'c2': 1 }]))
+		self.assertEquals(aggregates, Aggregates.fromChoices([3.5, 1.0]))
+
+	def testMergeAggregates(self):
+		aggregates = Aggregates.fromChoices([5.0, 2.0])
+		merge([5.0, 2.0], [{ 'c0': 5 }, { 'c1': 3 }], 1.0, { 'c0': 1 }, aggregates)
+		self.assertEquals(aggregates, Aggregates.fromChoices([5.0, 2.0]))
+		merge([5.0, 2.0], [{ 'c0': 5 }, { 'c1': 3 }], 3.0, { 'c0': 6 }, aggregates)
+		self.assertEquals(aggregates, Aggregates.fromChoices([3.0, 2.0]))
+
+	def testCoalesce(self):
+		self.assertEquals(self.buffer.put('bob', 5.0, { 'c0': 1 }), 5.0)
+		self.assertEquals(self.buffer.put('bob', 1.0, { 'c0': 3 }), 1.0)
+		self.assertEquals(self.buffer.put('bob', 2.0, { 'c0': 2 }), 1.0)
+		self.assertEquals(self.buffer.put('bob', 3.0, { 'c1': 1 }), 2.0)
+		self.assertEquals(self.buffer.get('bob'), ([1.0, 3.0], [{ 'c0': 3 }, { 'c1': 1 }]))
+		self.assertEquals(self.batches, [ ])
+		self.buffer.write = lambda batch: self.batches.append(self.buffer.get('bob'))
+		self.buffer.flush()
+		self.assertEquals(self.batches, [ ([1.0, 3.0], [{ 'c0': 3 }, { 'c1': 1 }]) ])
+		self.buffer.put('bob', 1.0, { 'c0': 3 })
+		self.buffer.put('bob', 3.0, { 'c1': 1 })
+		self.batches.pop()
+		self.buffer.write = self.batches.append
+		self.buffer.flush()
+		self.assertEquals(self.batches, [ [ ('bob', [1.0, 3.0], [{ 'c0': 3 }, { 'c1': 1 }]) ] ])
+		self.assertEquals(self.buffer.get('bob'), None)
+		self.assertEquals(self.buffer.stats, { 'writes': 6, 'stale': 1, 'flushes': 2, 'flushed': 2, 'failures': 0, 'dropped': 0 })
+
+	def testThresholds(self):
+		for i in range(3):
+			self.buffer.put('bob', 1.0, { 'c%d' % i: 1 })
+		self.assertEquals(len(self.batches), 1)
+		for i in range(5):
+			self.buffer.put('e%d' % i, 1.0, { 'c0': 1 })
+		self.assertEquals(len(self.batches), 2)
+		self.assertEquals(len(self.batches[1]), 5)
+
+	def testDiscardAndStop(self):
+		self.buffer.put('bob', 1.0, { 'c0': 1 })
+		self.assertTrue(self.buffer.discard('bob'))
+		self.assertFalse(self.buffer.discard('bob'))
+		self.buffer.put('alice', 1.0, { 'c0': 1 })
+		self.buffer.start().stop()
+		self.assertEquals(self.batches, [ [ ('alice', [1.0], [{ 'c0': 1 }]) ] ])
+
+	def testFailedFlush(self):
+		def down(batch):
+			raise IOError('unreachable')
+		self.buffer.write = down
+		self.buffer.put('bob', 5.0, { 'c0': 1 })
+		self.buffer.put('bob', 2.0, { 'c1': 1 })
+		self.assertFalse(self.buffer.flush())
+		self.assertEquals(self.buffer.stats['failures'], 1)
+		# The failed batch is kept, and what came in since wins over it
+		self.buffer.put('bob', 4.0, { 'c0': 2 })
+		self.buffer.write = self.batches.append
+		self.assertTrue(self.buffer.flush())
+		self.assertEquals(self.batches, [ [ ('bob', [2.0, 4.0], [{ 'c1': 1 }, { 'c0': 2 }]) ] ])
+		self.assertEquals(self.buffer.buffered, 0)
+
+	def testFailedFlushKeepsMerging(self):
+		# A failure coming back finds newer sets under the same key and merges
+		def racing(batch):
+			self.buffer.put('bob', 4.0, { 'c0': 2 })
+			self.buffer.put('bob', 1.0, { 'c2': 1 })
+			raise IOError('unreachable')
+		self.buffer.write = racing
+		self.buffer.put('bob', 5.0, { 'c0': 1 })
+		self.buffer.put('bob', 2.0, { 'c1': 1 })
+		self.buffer.flush()
+		self.assertEquals(self.buffer.get('bob'), ([2.0, 4.0, 1.0], [{ 'c1': 1 }, { 'c0': 2 }, { 'c2': 1 }]))
+		self.assertEquals(self.buffer.buffered, 3)
+
+	def testFailedKey(self):
+		# Only the set that failed is tried again, and only so often
+		def partial(batch):
+			self.batches.append(sorted(key for key, _, _ in batch))
+			return [ IOError('bad key') if key == 'bad' else None for key, _, _ in batch ]
+		self.buffer.write = partial
+		self.buffer.put('bad', 1.0, { 'c0': 1 })
+		self.buffer.put('good', 2.0, { 'c0': 1 })
+		self.assertFalse(self.buffer.flush())
+		self.buffer.put('bad', 3.0, { 'c1': 1 })
+		for _ in range(self.buffer.retries):
+			self.assertFalse(self.buffer.flush())
+		self.assertEquals(self.batches, [ [ 'bad', 'good' ] ] + [ [ 'bad' ] ] * self.buffer.retries)
+		self.assertEquals(self.buffer.get('bad'), None)
+		self.assertTrue(self.buffer.flush())
+		self.assertEquals(len(self.batches), self.buffer.retries+1)
+		self.assertEquals(self.buffer.stats, { 'writes': 3, 'stale': 0, 'flushes': 1, 'flushed': 1, 'failures': self.buffer.retries+1, 'dropped': 2 })
+		self.assertEquals((self.buffer.buffered, self.buffer.failed), (0, { }))
+
+	def testRecovery(self):
+		# A set written at last starts counting its failures afresh
+		outcomes = [ IOError('down') ] * self.buffer.retries
+		def flaky(batch):
+			if outcomes:
+				raise outcomes.pop()
+			self.batches.append(batch)
+		self.buffer.write = flaky
+		self.buffer.put('bob', 1.0, { 'c0': 1 })
+		for _ in range(self.buffer.retries):
+			self.buffer.flush()
+		self.assertTrue(self.buffer.flush())
+		self.assertEquals(self.batches, [ [ ('bob', [1.0], [{ 'c0': 1 }]) ] ])
+		self.assertEquals((self.buffer.stats['dropped'], self.buffer.failed), (0, { }))
+
+	def testLoopSurvivesFailures(self):
+		failures = [ IOError('unreachable') ]
+		def flaky(batch):
+			if failures:
+				raise failures.pop()
+			self.batches.append(batch)
+		self.buffer.write = flaky
+		self.buffer.interval = 0.01
+		self.buffer.put('bob', 1.0, { 'c0': 1 })
+		self.buffer.start()
+		while not self.batches:
+			time.sleep(0.01)
+		self.buffer.stop()
+		self.assertEquals(self.batches, [ [ ('bob', [1.0], [{ 'c0': 1 }]) ] ])
+		self.assertEquals((self.buffer.stats['failures'], self.buffer.stats['flushes']), (1, 1))
+
+	def testDiscardInFlight(self):
+		writing, release = threading.Event(), threading.Event()
+		def slow(batch):
+			writing.set()
+			release.wait()
+			self.batches.append(batch)
+		self.buffer.write = slow
+		self.buffer.put('bob', 1.0, { 'c0': 1 })
+		flusher = threading.Thread(target=self.buffer.flush)
+		flusher.start()
+		writing.wait()
+		dropped = [ ]
+		discarder = threading.Thread(target=lambda: dropped.append(self.buffer.discard('bob')))
+		discarder.start()
+		# The discard waits for the batch holding bob to be written
+		discarder.join(0.05)
+		self.assertEquals(dropped, [ ])
+		release.set()
+		flusher.join()
+		discarder.join()
+		self.assertEquals(dropped, [ True ])
+		self.assertEquals(self.batches, [ [ ('bob', [1.0], [{ 'c0': 1 }]) ] ])
+		self.assertEquals(self.buffer.get('bob'), None)
+
+
+if __name__ == "__main__":
+	unittest.main()